@@ -93,15 +93,16 @@ def getfacl_posix(path, connector: Connector, config, LOG: Logger):
     getfacl_cmd = config.get('tsi.getfacl', '/bin/false')
     command = "%s %s" % (getfacl_cmd, path)
     LOG.debug(command)
-    (success, result) = run_command(command, login_shell=config['tsi.use_login_shell'])
+    (success, result) = run_command(command, login_shell=config['tsi.use_login_shell'], config=config)
     if not success:
         connector.failed(result)
     else:
         patterns = ["user", "group", "default:user", "default:group"]
-        connector.ok()
-        for line in result.splitlines():
-            if True in [line.startswith(p) for p in patterns]:
-                connector.write_message(line)
+        with connector.reply():
+            connector.ok()
+            for line in result.splitlines():
+                if True in [line.startswith(p) for p in patterns]:
+                    connector.write_message(line)
 
 
 def prepare_posix_arg(val: str, remove):
@@ -145,7 +146,7 @@ def setfacl_posix(path: str, op: str, val: str, connector: Connector, config, LO
             setfacl_cmd, recursive, base_arg, arg, path)
 
     LOG.debug(command)
-    (success, result) = run_command(command, login_shell=config['tsi.use_login_shell'])
+    (success, result) = run_command(command, login_shell=config['tsi.use_login_shell'], config=config)
     if not success:
         connector.failed(result)
     else:
@@ -0,0 +1,241 @@
+"""
+Streaming a directory tree as a tar archive (TSI_GET_ARCHIVE)
+
+The archive is produced incrementally, with bounded memory, and is sent
+over the data channel in chunks, each preceded by a line with its length
+in bytes (as an ASCII decimal number). A zero length chunk marks the end
+of the archive.
+After the archive, the TSI writes a line
+
+   ERROR <error name> <path>
+
+for each file that could not be archived, and finally
+
+   END_ARCHIVE <files> <bytes> <number of errors>
+
+to the control channel.
+"""
+
+import errno
+import fnmatch
+import gzip
+import os
+import os.path
+import re
+import stat
+import tarfile
+import IO
+from Connector import Connector
+from Log import Logger
+from Utils import expand_variables, extract_parameter
+
+FORMATS = ["tar", "tar.gz"]
+
+
+class ChunkedWriter(object):
+    """ File-like object writing the data to the data channel in
+    length-prefixed chunks of (at least) the given size
+    """
+
+    def __init__(self, connector: Connector, chunk_size: int):
+        self.connector = connector
+        self.chunk_size = chunk_size
+        self.buffer = bytearray()
+        self.total = 0
+
+    def write(self, data) -> int:
+        self.buffer += data
+        if len(self.buffer) >= self.chunk_size:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if len(self.buffer) > 0:
+            self.connector.write_data(b"%d\n" % len(self.buffer))
+            self.connector.write_data(self.buffer)
+            self.total += len(self.buffer)
+            self.buffer = bytearray()
+
+    def close(self):
+        self.flush()
+        self.connector.write_data(b"0\n")
+
+
+class PaddedReader(object):
+    """ Reads exactly 'size' bytes from the file, padding with zeros if
+    the file was truncated in the meantime, or cannot be read anymore,
+    so the archive stays valid
+    """
+
+    def __init__(self, f, size: int):
+        self.f = f
+        self.remaining = size
+        self.truncated = False
+        self.read_error = None
+
+    def read(self, size: int = -1) -> bytes:
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = b""
+        if self.read_error is None:
+            try:
+                data = self.f.read(size)
+            except OSError as e:
+                self.read_error = e
+        if len(data) < size:
+            self.truncated = True
+            data += bytes(size - len(data))
+        self.remaining -= size
+        return data
+
+
+def matches(relative_path: str, patterns: list) -> bool:
+    """ Patterns without a '/' are matched against the file name,
+    others against the path relative to the archived directory
+    """
+    name = os.path.basename(relative_path)
+    for pattern in patterns:
+        if fnmatch.fnmatchcase(relative_path if "/" in pattern else name, pattern):
+            return True
+    return False
+
+
+class Archiver(object):
+    """ Adds a directory tree to a tar stream """
+
+    def __init__(self, tar: tarfile.TarFile, includes: list, excludes: list,
+                 user_cache, LOG: Logger):
+        self.tar = tar
+        self.includes = includes
+        self.excludes = excludes
+        self.user_cache = user_cache
+        self.LOG = LOG
+        self.files = 0
+        self.errors = []
+
+    def error(self, path: str, e: OSError):
+        name = errno.errorcode.get(e.errno, "EIO")
+        self.errors.append("ERROR %s %s" % (name, re.sub(r'[\r\n]', '?', path)))
+        self.LOG.debug("Error archiving %s: %s" % (path, str(e)))
+
+    def tarinfo(self, name: str, statinfo: os.stat_result) -> tarfile.TarInfo:
+        info = tarfile.TarInfo(name)
+        info.mode = stat.S_IMODE(statinfo.st_mode)
+        info.uid = statinfo.st_uid
+        info.gid = statinfo.st_gid
+        info.uname = IO.get_user_name(statinfo.st_uid, self.user_cache)
+        info.gname = IO.get_group_name(statinfo.st_gid, self.user_cache)
+        info.mtime = int(statinfo.st_mtime)
+        return info
+
+    def add(self, path: str, name: str, statinfo: os.stat_result):
+        """ Adds a file, directory or symbolic link """
+        info = self.tarinfo(name, statinfo)
+        if stat.S_ISDIR(statinfo.st_mode):
+            info.type = tarfile.DIRTYPE
+            self.tar.addfile(info)
+        elif stat.S_ISLNK(statinfo.st_mode):
+            info.type = tarfile.SYMTYPE
+            info.linkname = os.readlink(path)
+            self.tar.addfile(info)
+        elif stat.S_ISREG(statinfo.st_mode):
+            with open(path, "rb") as f:
+                info.size = statinfo.st_size
+                reader = PaddedReader(f, info.size)
+                self.tar.addfile(info, reader)
+                if reader.read_error is not None:
+                    # the (padded) member is in the archive, but its data is not valid
+                    self.error(path, reader.read_error)
+                    return
+                if reader.truncated:
+                    self.LOG.warning("File %s was truncated while reading" % path)
+        else:
+            # sockets, devices etc are skipped
+            return
+        self.files += 1
+
+    def add_tree(self, directory: str):
+        """ Adds the directory and its content (depth-first, using an
+        explicit stack), applying the include and exclude patterns.
+        Directories are only added if no include patterns are given.
+        """
+        base = os.path.dirname(directory.rstrip("/"))
+        stack = [directory.rstrip("/")]
+        while len(stack) > 0:
+            current = stack.pop()
+            name = os.path.relpath(current, base)
+            try:
+                if len(self.includes) == 0:
+                    self.add(current, name, os.lstat(current))
+                with os.scandir(current) as it:
+                    entries = sorted(it, key=lambda e: e.name)
+            except OSError as e:
+                self.error(current, e)
+                continue
+            subdirs = []
+            for entry in entries:
+                relative_path = os.path.relpath(entry.path, directory)
+                if matches(relative_path, self.excludes):
+                    continue
+                try:
+                    statinfo = entry.stat(follow_symlinks=False)
+                    if stat.S_ISDIR(statinfo.st_mode):
+                        subdirs.append(entry.path)
+                    elif len(self.includes) == 0 or matches(relative_path, self.includes):
+                        self.add(entry.path, os.path.join(name, entry.name), statinfo)
+                except OSError as e:
+                    self.error(entry.path, e)
+            stack.extend(reversed(subdirs))
+
+
+def get_archive(msg: str, connector: Connector, config: dict, LOG: Logger):
+    """ Streams a tar archive of a directory to UNICORE/X via the data
+       channel (see above for the format).
+       The message sent by UNICORE/X is scanned for:
+           TSI_FILE           - the directory
+           TSI_ARCHIVE_FORMAT - 'tar' or 'tar.gz' (optional, default: tar)
+       and optional lines
+           #TSI_INCLUDE <pattern>
+           #TSI_EXCLUDE <pattern>
+       with glob patterns selecting the files to include, or files and
+       directories to exclude.
+    """
+    directory = expand_variables(extract_parameter(msg, "FILE"))
+    archive_format = extract_parameter(msg, "ARCHIVE_FORMAT", "tar")
+    if archive_format not in FORMATS:
+        connector.failed("Unsupported archive format '%s', must be one of %s" % (
+            archive_format, FORMATS))
+        return
+    if not os.path.isdir(directory):
+        connector.failed("Not a directory: %s" % directory)
+        return
+    includes = []
+    excludes = []
+    for line in msg.splitlines():
+        if line.startswith("#TSI_INCLUDE "):
+            includes.append(line[len("#TSI_INCLUDE "):])
+        elif line.startswith("#TSI_EXCLUDE "):
+            excludes.append(line[len("#TSI_EXCLUDE "):])
+
+    LOG.debug("Archiving %s (%s)" % (directory, archive_format))
+    connector.ok("ENDOFMESSAGE")
+    writer = ChunkedWriter(connector, connector.buf_size)
+    out = writer
+    if archive_format == "tar.gz":
+        level = int(config.get('tsi.io.compression_level', 1))
+        out = gzip.GzipFile(filename="", mode="wb", fileobj=writer, compresslevel=level, mtime=0)
+    archiver = None
+    try:
+        with tarfile.open(fileobj=out, mode="w|", format=tarfile.PAX_FORMAT) as tar:
+            archiver = Archiver(tar, includes, excludes, config.get('tsi.user_cache'), LOG)
+            archiver.add_tree(directory)
+        if out is not writer:
+            out.close()
+    finally:
+        # always terminate the stream, so UNICORE/X does not hang
+        writer.close()
+    with connector.reply():
+        for error in archiver.errors:
+            connector.write_message(error)
+        connector.write_message("END_ARCHIVE %d %d %d" % (archiver.files, writer.total,
+                                                          len(archiver.errors)))
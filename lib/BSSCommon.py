@@ -248,7 +248,7 @@ class BSSBase(object):
         """ Get info about all the batch jobs and parses it.
         """
         qstat_cmd = config["tsi.qstat_cmd"]
-        (success, qstat_output) = Utils.run_command(qstat_cmd)
+        (success, qstat_output) = Utils.run_command(qstat_cmd, config=config)
         if not success:
             connector.failed(qstat_output)
             return
@@ -260,7 +260,7 @@ class BSSBase(object):
         """ Get list of the processes on this machine.
         """
         ps_cmd = Utils.extract_parameter(msg, "PS", config["tsi.get_processes_cmd"])
-        Utils.run_and_report(ps_cmd, connector)
+        Utils.run_and_report(ps_cmd, connector, config=config)
 
 
     def parse_job_details(self, raw_info):
@@ -283,7 +283,7 @@ class BSSBase(object):
     def get_job_details(self, msg: str, connector: Connector, config: dict, LOG: Logger):
         bssid = Utils.extract_parameter(msg, "BSSID")
         cmd = config["tsi.details_cmd"] + " " + bssid
-        (success, output) = Utils.run_command(cmd)
+        (success, output) = Utils.run_command(cmd, config=config)
         if not success:
             connector.failed(output)
             return
@@ -298,19 +298,19 @@ class BSSBase(object):
     def abort_job(self, msg: str, connector: Connector, config: dict, LOG: Logger):
         bssid = Utils.extract_parameter(msg, "BSSID")
         cmd = config["tsi.abort_cmd"] % bssid
-        Utils.run_and_report(cmd, connector, self.use_login_shell)
+        Utils.run_and_report(cmd, connector, self.use_login_shell, config)
 
 
     def hold_job(self, msg: str, connector: Connector, config: dict, LOG: Logger):
         bssid = Utils.extract_parameter(msg, "BSSID")
         cmd = config["tsi.hold_cmd"] + " " + bssid
-        Utils.run_and_report(cmd, connector, self.use_login_shell)
+        Utils.run_and_report(cmd, connector, self.use_login_shell, config)
 
 
     def resume_job(self, msg: str, connector: Connector, config: dict, LOG: Logger):
         bssid = Utils.extract_parameter(msg, "BSSID")
         cmd = config["tsi.resume_cmd"] + " " + bssid
-        Utils.run_and_report(cmd, connector, self.use_login_shell)
+        Utils.run_and_report(cmd, connector, self.use_login_shell, config)
 
 
     def get_budget(self, msg: str, connector: Connector, config: dict, LOG: Logger):
@@ -328,7 +328,7 @@ class BSSBase(object):
 
     def get_partitions(self, msg: str, connector: Connector, config: dict, LOG: Logger):
         cmd = config["tsi.get_partitions_cmd"]
-        (success, output) = Utils.run_command(cmd)
+        (success, output) = Utils.run_command(cmd, config=config)
         if not success:
             connector.failed(output)
             return
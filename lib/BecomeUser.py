@@ -2,6 +2,7 @@
 
 import os
 
+import Shell
 from Log import Logger
 from UserCache import UserCache
 
@@ -213,4 +214,6 @@ def restore_id(config: dict):
         # re-set environment to something harmless
         os.environ['HOME'] = "/tmp"
         os.environ['USER'] = "nobody"
-        os.environ['LOGNAME'] = "nobody"
\ No newline at end of file
+        os.environ['LOGNAME'] = "nobody"
+    # stop persistent shells that are no longer used
+    Shell.cleanup(config)
\ No newline at end of file
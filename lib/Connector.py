@@ -1,6 +1,9 @@
 """ Wrapper class around common I/O operations """
 
 import base64
+import io
+import ssl
+from contextlib import contextmanager
 from os import _exit
 from socket import socket, AF_UNIX, SOCK_STREAM
 from time import sleep, time
@@ -9,8 +12,64 @@ import threading
 import Utils
 from Log import Logger
 
+class Transfer(object):
+    """ Measures the throughput of a data transfer, and (in adaptive mode)
+    doubles the block size for as long as this increases the throughput,
+    measured over a number of blocks
+    """
+
+    window = 8
+
+    def __init__(self, block_size: int, max_block_size: int = 0, adaptive: bool = False):
+        self.block_size = block_size
+        self.max_block_size = max(block_size, max_block_size) if adaptive else block_size
+        self.adaptive = adaptive and self.max_block_size > block_size
+        self.start = time()
+        self.total = 0
+        self.window_start = self.start
+        self.window_blocks = 0
+        self.window_bytes = 0
+        self.rate = 0.0
+
+    def record(self, length: int):
+        """ Records the number of bytes transferred in one block """
+        self.total += length
+        if not self.adaptive:
+            return
+        self.window_bytes += length
+        self.window_blocks += 1
+        if self.window_blocks < self.window:
+            return
+        now = time()
+        rate = self.window_bytes / max(now - self.window_start, 1e-6)
+        if rate > 1.1 * self.rate:
+            self.block_size = min(2 * self.block_size, self.max_block_size)
+            self.adaptive = self.block_size < self.max_block_size
+        else:
+            self.adaptive = False
+        self.rate = rate
+        self.window_start = now
+        self.window_blocks = 0
+        self.window_bytes = 0
+
+    def __str__(self):
+        elapsed = max(time() - self.start, 1e-6)
+        return "%d bytes in %.3f sec (%.2f MB/sec, block size %d)" % (
+            self.total, elapsed, self.total / elapsed / 1048576, self.block_size)
+
+
 class Connector():
-    def __init__(self, command: socket, data: socket, LOG: Logger):
+
+    # whether file data can be sent to the data socket via sendfile()
+    zero_copy = False
+    # adaptive block size for transfers (see Transfer)
+    adaptive = False
+    max_buf_size = 0
+    # buffered reply (see reply())
+    reply_buffer = None
+    reply_buffer_size = 65536
+
+    def __init__(self, command: socket, data: socket, LOG: Logger, config: dict = None):
         self.data = data
         self.command = command
         self.control_in = command.makefile("r")
@@ -19,6 +78,12 @@ class Connector():
         self.data_out = data.makefile("wb")
         self.LOG = LOG
         self.buf_size = 32768
+        self.zero_copy = not isinstance(data, ssl.SSLSocket)
+        if config is not None:
+            self.buf_size = int(config.get('tsi.io.buffer_size', self.buf_size))
+            self.max_buf_size = int(config.get('tsi.io.max_buffer_size', 0))
+            self.adaptive = config.get('tsi.io.adaptive_buffer', False)
+            self.reply_buffer_size = int(config.get('tsi.reply_buffer_size', self.reply_buffer_size))
 
     def failed(self, message: str):
         """ Write single line of TSI_FAILED and error message to control
@@ -54,10 +119,44 @@ class Connector():
     def write_message(self, message):
         """ Write message to control channel and add newline """
         if message is not None:
+            if self.reply_buffer is not None:
+                message = Utils.encode(message)
+                self.reply_buffer.append(message)
+                self.reply_buffered += len(message) + 1
+                if self.reply_buffered >= self.reply_buffer_size:
+                    self.flush_reply()
+                return
             self.control_out.write(Utils.encode(message))
             self.control_out.write(u"\n")
             self.control_out.flush()
 
+    @contextmanager
+    def reply(self):
+        """ Context manager for writing a multi-line reply. The messages
+        are collected and written to the control channel only when the
+        buffer ('tsi.reply_buffer_size') is full, and at the end of the reply
+        """
+        if self.reply_buffer is not None:
+            # already inside a reply
+            yield self
+            return
+        self.reply_buffer = []
+        self.reply_buffered = 0
+        try:
+            yield self
+        finally:
+            self.flush_reply()
+            self.reply_buffer = None
+
+    def flush_reply(self):
+        """ Write out the buffered messages """
+        if self.reply_buffer:
+            self.reply_buffer.append(u"")
+            self.control_out.write(u"\n".join(self.reply_buffer))
+            self.control_out.flush()
+        self.reply_buffer = []
+        self.reply_buffered = 0
+
     def read_data(self, maxlen):
         limit = min(maxlen, self.buf_size)
         return self.data_in.read(limit)
@@ -69,6 +168,53 @@ class Connector():
             written = len(data)
         return written
 
+    def read_data_into(self, buffer: memoryview):
+        """ Read data into the given buffer (without allocating a new one)
+        Returns the number of bytes read, 0 if the channel was closed.
+        """
+        return self.data_in.readinto(buffer)
+
+    def read_available_data_into(self, buffer: memoryview):
+        """ Read the data that is available (at least one byte) into the
+        given buffer, without waiting for the buffer to be filled.
+        Returns the number of bytes read, 0 if the channel was closed.
+        """
+        return self.data_in.readinto1(buffer)
+
+    def new_transfer(self) -> Transfer:
+        """ Returns a Transfer for measuring throughput and block size """
+        return Transfer(self.buf_size, self.max_buf_size, self.adaptive)
+
+    def write_file(self, f: io.FileIO, offset: int, length: int, transfer: Transfer = None):
+        """ Write 'length' bytes of the file, starting at 'offset', to the
+        data channel. For plain TCP connections, the data is sent directly
+        from the file via sendfile(), otherwise it is copied using a
+        buffer (with the block size given by the transfer).
+        Returns the number of bytes written, which is less than 'length'
+        if the end of the file was reached.
+        """
+        if transfer is None:
+            transfer = self.new_transfer()
+        if length <= 0:
+            return 0
+        if self.zero_copy:
+            self.data_out.flush()
+            written = self.data.sendfile(f, offset, length)
+            transfer.record(written)
+            return written
+        buf = bytearray(min(length, transfer.max_block_size))
+        view = memoryview(buf)
+        f.seek(offset)
+        total = 0
+        while total < length:
+            read = f.readinto(view[:min(transfer.block_size, length - total)])
+            if not read:
+                break
+            self.write_data(view[:read])
+            transfer.record(read)
+            total += read
+        return total
+
     def close(self):
         for s in self.command, self.data:
             try:
@@ -156,6 +302,7 @@ class StreamConnector(Connector):
         self.out_stream = out_stream
         self.LOG = LOG
         self.buf_size = 32768
+        self.pending_data = b""
 
     def read_message(self, termination="ENDOFMESSAGE"):
         """ Read message from stdin """
@@ -194,9 +341,56 @@ class StreamConnector(Connector):
             raise ValueError("Expected base64 encoded data chunk")
         return base64.b64decode(msg)
 
+    def read_data_into(self, buffer: memoryview):
+        """ Read data into the given buffer, keeping what does not fit
+        for the next call
+        """
+        if len(self.pending_data) == 0:
+            self.pending_data = self.read_data(len(buffer))
+        length = min(len(buffer), len(self.pending_data))
+        buffer[:length] = self.pending_data[:length]
+        self.pending_data = self.pending_data[length:]
+        return length
+
+    def read_available_data_into(self, buffer: memoryview):
+        return self.read_data_into(buffer)
+
     def write_data(self, data):
         """ Write data to stdout as a base64 encoded block """
         self.write_message("---BEGIN DATA BASE64---")
         self.write_message(base64.b64encode(data))
         self.write_message("---END DATA---")
         return len(data)
+
+
+class BatchConnector(Connector):
+    """ Collects the replies to the control channel in memory,
+    used to run the sub-commands of a '#TSI_BATCH' message.
+    The data channel is not available.
+    """
+
+    def __init__(self, LOG: Logger):
+        self.control_out = io.StringIO()
+        self.LOG = LOG
+        self.buf_size = 32768
+
+    def read_data(self, maxlen):
+        raise IOError("Data channel cannot be used in batch mode")
+
+    def read_data_into(self, buffer):
+        raise IOError("Data channel cannot be used in batch mode")
+
+    def read_available_data_into(self, buffer):
+        raise IOError("Data channel cannot be used in batch mode")
+
+    def write_data(self, data):
+        raise IOError("Data channel cannot be used in batch mode")
+
+    def take_reply(self):
+        """ Returns and clears the collected replies """
+        reply = self.control_out.getvalue()
+        self.control_out = io.StringIO()
+        return reply
+
+    def close(self):
+        pass
@@ -0,0 +1,250 @@
+"""
+Server-side copying and moving of files and directories
+(TSI_COPY and TSI_MOVE), without running 'cp' or 'mv' in a shell
+
+File data is copied in the kernel: by cloning the file (reflink) if
+the file system supports it, otherwise using copy_file_range(), with
+a plain read/write loop as the last resort. Moving within a file
+system is a simple rename.
+
+The reply is
+
+   TSI_OK
+   PROGRESS <files copied> <bytes copied>   (for long copies)
+   ERROR <error name> <path>                (for each failed file)
+   END_COPY <files copied> <bytes copied> <number of errors>
+
+i.e. errors for single files do not stop the copy.
+"""
+
+import errno
+import fcntl
+import os
+import os.path
+import re
+import shutil
+import stat
+import time
+from Connector import Connector
+from Log import Logger
+from Utils import expand_variables, extract_parameter
+
+# ioctl to clone a file (see ioctl_ficlone(2))
+FICLONE = 0x40049409
+
+# size of the blocks copied with copy_file_range()
+BLOCK_SIZE = 64 * 1024 * 1024
+
+
+class Copier(object):
+    """ Copies files and directory trees, collecting statistics and errors,
+    and reporting progress to UNICORE/X every 'progress_interval' seconds
+    """
+
+    def __init__(self, connector: Connector, progress_interval: int, LOG: Logger):
+        self.connector = connector
+        self.progress_interval = progress_interval
+        self.LOG = LOG
+        self.files = 0
+        self.bytes = 0
+        self.errors = 0
+        self.last_report = time.time()
+
+    def error(self, path: str, e: OSError):
+        self.errors += 1
+        name = errno.errorcode.get(e.errno, "EIO")
+        self.connector.write_message("ERROR %s %s" % (name, re.sub(r'[\r\n]', '?', path)))
+        self.LOG.debug("Error copying %s: %s" % (path, str(e)))
+
+    def progress(self):
+        if self.progress_interval > 0 and time.time() - self.last_report >= self.progress_interval:
+            self.connector.write_message("PROGRESS %d %d" % (self.files, self.bytes))
+            self.last_report = time.time()
+
+    def finish(self):
+        self.connector.write_message("END_COPY %d %d %d" % (self.files, self.bytes, self.errors))
+
+    def copy_data(self, source_fd: int, target_fd: int):
+        """ Copies the content of the source file to the (empty) target file """
+        try:
+            fcntl.ioctl(target_fd, FICLONE, source_fd)
+            self.bytes += os.fstat(source_fd).st_size
+            return
+        except OSError:
+            pass
+        use_copy_file_range = hasattr(os, "copy_file_range")
+        while True:
+            if use_copy_file_range:
+                try:
+                    copied = os.copy_file_range(source_fd, target_fd, BLOCK_SIZE)
+                except OSError as e:
+                    if e.errno not in [errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                                       errno.EOPNOTSUPP]:
+                        raise
+                    use_copy_file_range = False
+                    continue
+            else:
+                data = os.read(source_fd, 1048576)
+                copied = len(data)
+                written = 0
+                while written < copied:
+                    written += os.write(target_fd, data[written:])
+            if copied == 0:
+                break
+            self.bytes += copied
+            self.progress()
+
+    def copy_file(self, source: str, target: str, statinfo: os.stat_result):
+        """ Copies a single file (or symbolic link), keeping the permissions """
+        try:
+            if stat.S_ISLNK(statinfo.st_mode):
+                # replace an existing target, as for regular files
+                if os.path.lexists(target) and not os.path.isdir(target):
+                    os.unlink(target)
+                os.symlink(os.readlink(source), target)
+            elif stat.S_ISREG(statinfo.st_mode):
+                source_fd = os.open(source, os.O_RDONLY)
+                try:
+                    target_fd = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                                        stat.S_IMODE(statinfo.st_mode))
+                    try:
+                        self.copy_data(source_fd, target_fd)
+                        os.fchmod(target_fd, stat.S_IMODE(statinfo.st_mode))
+                    finally:
+                        os.close(target_fd)
+                finally:
+                    os.close(source_fd)
+            else:
+                raise OSError(errno.EOPNOTSUPP, "Not a regular file")
+            self.files += 1
+        except OSError as e:
+            self.error(source, e)
+        self.progress()
+
+    def copy_tree(self, source: str, target: str):
+        """ Copies the directory tree (using an explicit stack instead of recursion).
+        The permissions of the directories are set after their content has
+        been copied (deepest first), since they might not be writable
+        """
+        stack = [(source, target)]
+        modes = []
+        while len(stack) > 0:
+            source_dir, target_dir = stack.pop()
+            try:
+                mode = stat.S_IMODE(os.stat(source_dir).st_mode)
+                os.makedirs(target_dir, exist_ok=True)
+                modes.append((source_dir, target_dir, mode))
+                with os.scandir(source_dir) as it:
+                    entries = list(it)
+            except OSError as e:
+                self.error(source_dir, e)
+                continue
+            for entry in entries:
+                target_path = os.path.join(target_dir, entry.name)
+                try:
+                    statinfo = entry.stat(follow_symlinks=False)
+                except OSError as e:
+                    self.error(entry.path, e)
+                    continue
+                if stat.S_ISDIR(statinfo.st_mode):
+                    stack.append((entry.path, target_path))
+                else:
+                    self.copy_file(entry.path, target_path, statinfo)
+        # subdirectories are always listed after their parent
+        for source_dir, target_dir, mode in reversed(modes):
+            try:
+                os.chmod(target_dir, mode)
+            except OSError as e:
+                self.error(source_dir, e)
+
+    def copy(self, source: str, target: str):
+        statinfo = os.lstat(source)
+        if stat.S_ISDIR(statinfo.st_mode):
+            self.copy_tree(source, target)
+        else:
+            self.copy_file(source, target, statinfo)
+
+
+def is_inside(source: str, target: str) -> bool:
+    """ Checks if the target is the source directory itself or inside it,
+    resolving symbolic links and relative path components
+    """
+    if not os.path.isdir(source):
+        return False
+    source = os.path.realpath(source).rstrip("/") + "/"
+    parent = os.path.realpath(os.path.dirname(target.rstrip("/")) or ".").rstrip("/") + "/"
+    return parent.startswith(source) or os.path.realpath(target).rstrip("/") + "/" == source
+
+
+def get_paths(msg: str):
+    """ Returns the source and target paths. As with 'cp' and 'mv', if the
+    target is an existing directory, the source is copied into it
+    """
+    source = expand_variables(extract_parameter(msg, "SOURCE"))
+    target = expand_variables(extract_parameter(msg, "TARGET"))
+    if os.path.isdir(target):
+        target = os.path.join(target, os.path.basename(source.rstrip("/")))
+    return source, target
+
+
+def copy(msg: str, connector: Connector, config: dict, LOG: Logger):
+    """ Copies a file or directory (recursively)
+       The message sent by UNICORE/X is scanned for:
+           TSI_SOURCE - the file or directory to copy
+           TSI_TARGET - the target path
+    """
+    source, target = get_paths(msg)
+    if not os.path.lexists(source):
+        connector.failed("No such file or directory: %s" % source)
+        return
+    if os.path.exists(target) and os.path.samefile(source, target):
+        connector.failed("%s and %s are the same file" % (source, target))
+        return
+    if is_inside(source, target):
+        connector.failed("Cannot copy directory %s into itself" % source)
+        return
+    LOG.debug("Copying %s to %s" % (source, target))
+    copier = Copier(connector, int(config.get('tsi.copy.progress_interval', 10)), LOG)
+    connector.ok()
+    copier.copy(source, target)
+    copier.finish()
+
+
+def move(msg: str, connector: Connector, config: dict, LOG: Logger):
+    """ Moves a file or directory. Within a file system, it is renamed,
+       otherwise it is copied and the source is removed (if the copy
+       was successful)
+       The message sent by UNICORE/X is scanned for:
+           TSI_SOURCE - the file or directory to move
+           TSI_TARGET - the target path
+    """
+    source, target = get_paths(msg)
+    if not os.path.lexists(source):
+        connector.failed("No such file or directory: %s" % source)
+        return
+    if is_inside(source, target):
+        connector.failed("Cannot move directory %s into itself" % source)
+        return
+    LOG.debug("Moving %s to %s" % (source, target))
+    copier = Copier(connector, int(config.get('tsi.copy.progress_interval', 10)), LOG)
+    try:
+        os.rename(source, target)
+        connector.ok()
+        copier.files += 1
+        copier.finish()
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            connector.failed("Cannot move %s to %s: %s" % (source, target, str(e)))
+            return
+    connector.ok()
+    copier.copy(source, target)
+    if copier.errors == 0:
+        try:
+            if os.path.isdir(source) and not os.path.islink(source):
+                shutil.rmtree(source)
+            else:
+                os.unlink(source)
+        except OSError as e:
+            copier.error(source, e)
+    copier.finish()
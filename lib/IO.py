@@ -2,16 +2,23 @@
    and helper functions
 """
 
+import errno
 import io
 import grp
+import hashlib
 import pwd
 import re
 import os
 import os.path
+import shlex
 import stat
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from Connector import Connector
-from Utils import expand_variables, extract_parameter, run_command
+from Utils import expand_variables, extract_number, extract_parameter, run_command
 from Log import Logger
+from UserCache import UserCache
 
 def get_file_chunk(msg: str, connector: Connector, config: dict, LOG: Logger):
     """Return part of a file to UNICORE/X via the data_out stream.
@@ -19,6 +26,15 @@ def get_file_chunk(msg: str, connector: Connector, config: dict, LOG: Logger):
            TSI_FILE   - name of file to return
            TSI_START  - start byte
            TSI_LENGTH - how many bytes to return
+           TSI_COMPRESSION - compression requested by UNICORE/X (optional)
+           TSI_SPARSE - 'true' to send only the data extents of sparse
+                        files (optional)
+       If the data is compressed, the reply contains a
+       'TSI_COMPRESSION <mode>' line, and TSI_LENGTH is the uncompressed length.
+       If the file has holes and sparse transfer was requested, the reply
+       contains a 'TSI_SPARSE <number of extents>' line, followed by one
+       'TSI_EXTENT <offset> <length>' line per data extent (the offset
+       being relative to TSI_START), and only these extents are sent
     """
     path = extract_parameter(msg, 'FILE')
     path = expand_variables(path)
@@ -28,6 +44,37 @@ def get_file_chunk(msg: str, connector: Connector, config: dict, LOG: Logger):
     LOG.debug("Getting data from %s start at %d length %d" % (path, start, length))
 
     with io.FileIO(path, "rb") as f:
+        file_info = os.fstat(f.fileno())
+        if stat.S_ISREG(file_info.st_mode):
+            # stream the data, without reading it into memory first
+            available = max(0, min(length, file_info.st_size - start))
+            if extract_parameter(msg, "SPARSE", "false").lower() == "true":
+                extents = get_data_extents(f, start, available)
+                if (extents is not None and len(extents) <= MAX_EXTENTS
+                        and sum(e[1] for e in extents) < available):
+                    header = "".join("TSI_EXTENT %d %d\n" % e for e in extents)
+                    connector.ok("TSI_LENGTH %s\nTSI_SPARSE %d\n%sENDOFMESSAGE" % (
+                        available, len(extents), header))
+                    transfer = connector.new_transfer()
+                    for offset, extent_length in extents:
+                        send_file_data(connector, f, start + offset, extent_length, transfer, path, LOG)
+                    LOG.debug("Sent %s in %d extents" % (transfer, len(extents)))
+                    return
+            compression = get_compression(msg, config)
+            if compression is not None and not is_compressible(f, start, available, config):
+                LOG.debug("Data from %s is not compressible, sending it uncompressed" % path)
+                compression = None
+            transfer = connector.new_transfer()
+            if compression is not None:
+                connector.ok("TSI_LENGTH %s\nTSI_COMPRESSION %s\nENDOFMESSAGE" % (available, compression))
+                sent = send_compressed(connector, f, start, available, config, transfer)
+                LOG.debug("Sent %s, compressed to %d bytes" % (transfer, sent))
+            else:
+                connector.ok("TSI_LENGTH %s\nENDOFMESSAGE" % available)
+                send_file_data(connector, f, start, available, transfer, path, LOG)
+                LOG.debug("Sent %s" % transfer)
+            return
+
         if f.seekable():
             f.seek(start)
         buf = bytearray(length)
@@ -59,8 +106,23 @@ def put_file_chunk(msg: str, connector: Connector, config: dict, LOG: Logger):
     """Write part of a file, reading data from UNICORE/X via the data_in stream.
        The message sent by UNICORE/X is scanned for:
            TSI_FILE   - name of file to write and mode
-           TSI_FILESACTION  - what to do (overwrite = 1 , append = 3)
+           TSI_FILESACTION  - what to do (overwrite = 1 , append = 3,
+                              write at TSI_OFFSET = 4)
            TSI_LENGTH - how many bytes to return
+           TSI_OFFSET - position to write the data at (for action 4)
+           TSI_FILE_SIZE - final size of the file (optional, for action 4)
+           TSI_COMPRESSION - compression requested by UNICORE/X (optional)
+           TSI_SPARSE - 'true' if only the data extents (given as
+                        '#TSI_EXTENT <offset> <length>' lines) are sent,
+                        the rest of the file being holes (optional)
+       If the TSI accepts the compression, its reply contains a
+       'TSI_COMPRESSION <mode>' line, and UNICORE/X sends the compressed
+       data (TSI_LENGTH still being the uncompressed length)
+
+       With action 4, the file is never truncated, so that disjoint parts
+       of a file can be written concurrently, e.g. by several TSI
+       workers. If TSI_FILE_SIZE is given, a shorter file is extended to
+       that size first.
     """
     path_and_mode = extract_parameter(msg, "FILE")
     mode_index = path_and_mode.rindex(" ")
@@ -74,30 +136,91 @@ def put_file_chunk(msg: str, connector: Connector, config: dict, LOG: Logger):
 
     length = int(extract_parameter(msg, "LENGTH"))
 
-    LOG.debug("Writing %d bytes of data to %s" % (length, path))
+    # position for writing at an offset, None when writing sequentially
+    position = None
+    if action == "4":
+        position = extract_number(msg, "OFFSET")
+        if position < 0:
+            connector.failed("TSI_FILESACTION 4 requires a valid TSI_OFFSET")
+            return
+        LOG.debug("Writing %d bytes of data to %s at offset %d" % (length, path, position))
+    else:
+        LOG.debug("Writing %d bytes of data to %s" % (length, path))
 
     if action == "3":
         open_mode = "ab"
     else:
         open_mode = "wb"
 
-    with io.FileIO(path, open_mode) as f:
+    fsync_policy = config.get('tsi.io.fsync', 'none')
+    fsync = fsync_policy == "always"
+
+    # preallocating extends the file, so it cannot be used for appending
+    preallocate_space = action != "3" and length > 0 and config.get('tsi.io.preallocate', False)
+
+    compression = get_compression(msg, config)
+
+    extents = None
+    if extract_parameter(msg, "SPARSE", "false").lower() == "true":
+        try:
+            extents = get_extents(msg, length)
+        except ValueError as e:
+            connector.failed(str(e))
+            return
+        if action == "3":
+            connector.failed("Sparse data cannot be appended")
+            return
+        # the holes must neither be filled by preallocation, nor be compressed
+        preallocate_space = False
+        compression = None
+
+    if position is not None:
+        # do not truncate
+        f = io.FileIO(os.open(path, os.O_WRONLY | os.O_CREAT, 0o666), "wb")
+    else:
+        f = io.FileIO(path, open_mode)
+    with f:
+        if position is not None:
+            file_size = extract_number(msg, "FILE_SIZE")
+            # only ever extend the file, other parts may be written concurrently
+            if os.fstat(f.fileno()).st_size < file_size:
+                os.ftruncate(f.fileno(), file_size)
+        if preallocate_space:
+            preallocate(f, length, LOG, position)
         # the next message tells UNICORE/X to start sending data
-        connector.ok("ENDOFMESSAGE")
-        remaining = length
+        if compression is not None:
+            connector.ok("TSI_COMPRESSION %s\nENDOFMESSAGE" % compression)
+        else:
+            connector.ok("ENDOFMESSAGE")
+        transfer = connector.new_transfer()
+        buf = get_buffer(config, transfer.max_block_size)
 
-        while remaining > 0:
-            buf = connector.read_data(remaining)
-            bytes_read = len(buf)
-            remaining -= bytes_read
-
-            # write it out, taking care to handle partial writes
-            write_offset = 0
-            must_write = bytes_read
-            while must_write > 0:
-                written = f.write(buf[write_offset:bytes_read])
-                write_offset += written
-                must_write -= written
+        try:
+            if compression is not None:
+                receive_compressed(connector, f, length, buf, transfer, fsync, position)
+            elif extents is not None:
+                for offset, extent_length in extents:
+                    if position is None:
+                        f.seek(offset)
+                        receive_data(connector, f, extent_length, buf, transfer, fsync)
+                    else:
+                        receive_data(connector, f, extent_length, buf, transfer, fsync,
+                                     position + offset)
+                # create the hole at the end, if any
+                if position is None:
+                    f.truncate(length)
+                elif length > 0 and (len(extents) == 0 or sum(extents[-1]) < length):
+                    os.pwrite(f.fileno(), b"\0", position + length - 1)
+            else:
+                receive_data(connector, f, length, buf, transfer, fsync, position)
+        except:
+            if preallocate_space and position is None:
+                f.truncate(f.tell())
+            raise
+
+        if fsync_policy == "end":
+            os.fsync(f.fileno())
+    LOG.debug("Received %s" % transfer)
 
     # change mode to requested mode - ignore failure
     try:
@@ -105,6 +228,407 @@ def put_file_chunk(msg: str, connector: Connector, config: dict, LOG: Logger):
     except OSError as e:
         LOG.debug(f"Cannot chmod: {repr(e)}")
 
+
+def send_file_data(connector: Connector, f: io.FileIO, start: int, length: int,
+                   transfer, path: str, LOG: Logger):
+    """ Sends 'length' bytes of the (regular) file to UNICORE/X,
+    padding with zeros if the file was truncated in the meantime
+    """
+    written = connector.write_file(f, start, length, transfer)
+    if written < length:
+        LOG.warning("File %s was truncated while reading" % path)
+        send_zeros(connector, length - written)
+
+
+def send_zeros(connector: Connector, length: int):
+    """ Sends 'length' zero bytes to UNICORE/X """
+    written = 0
+    while written < length:
+        written += connector.write_data(bytes(min(length - written, connector.buf_size)))
+
+
+def get_file_chunks(msg: str, connector: Connector, config: dict, LOG: Logger):
+    """Return several parts of one or more files to UNICORE/X via the
+       data_out stream, in a single request.
+       The message sent by UNICORE/X contains one line
+           #TSI_CHUNK <start byte> <length> <file name>
+       per part. The parts are read ordered by file and start byte (for
+       sequential disk access). The reply lists the parts in the order
+       in which their data is sent:
+           TSI_OK
+           TSI_CHUNK <index of the part in the request> <length>
+           ...
+           ENDOFMESSAGE
+    """
+    chunks = []
+    for line in msg.splitlines():
+        if line.startswith("#TSI_CHUNK "):
+            try:
+                start, length, path = line[len("#TSI_CHUNK "):].split(" ", 2)
+                start, length = int(start), int(length)
+            except ValueError:
+                connector.failed("Invalid chunk specification '%s'" % line)
+                return
+            if start < 0 or length < 0:
+                connector.failed("Invalid chunk specification '%s'" % line)
+                return
+            chunks.append((expand_variables(path), start, length))
+    if len(chunks) == 0:
+        connector.failed("No chunks requested")
+        return
+
+    sizes = {}
+    for path, _, _ in chunks:
+        if path not in sizes:
+            file_info = os.stat(path)
+            if not stat.S_ISREG(file_info.st_mode):
+                raise IOError("Not a regular file: %s" % path)
+            sizes[path] = file_info.st_size
+    order = sorted(range(len(chunks)), key=lambda i: (chunks[i][0], chunks[i][1]))
+    available = [max(0, min(length, sizes[path] - start)) for path, start, length in chunks]
+    header = "".join("TSI_CHUNK %d %d\n" % (i, available[i]) for i in order)
+    connector.ok(header + "ENDOFMESSAGE")
+    LOG.debug("Sending %d chunks from %d files" % (len(chunks), len(sizes)))
+    transfer = connector.new_transfer()
+    # the chunks are grouped by file, so only one file is open at a time
+    pos = 0
+    while pos < len(order):
+        path = chunks[order[pos]][0]
+        end = pos
+        while end < len(order) and chunks[order[end]][0] == path:
+            end += 1
+        f = None
+        try:
+            # non-blocking, in case the file was replaced by a FIFO
+            f = io.FileIO(os.open(path, os.O_RDONLY | os.O_NONBLOCK), "rb")
+            if not stat.S_ISREG(os.fstat(f.fileno()).st_mode):
+                raise IOError("Not a regular file: %s" % path)
+        except OSError as e:
+            # the reply has already been sent, so the data is replaced by zeros
+            LOG.warning("Cannot read %s: %s" % (path, str(e)))
+            if f is not None:
+                f.close()
+            f = None
+        try:
+            for i in order[pos:end]:
+                if f is None:
+                    send_zeros(connector, available[i])
+                else:
+                    send_file_data(connector, f, chunks[i][1], available[i], transfer, path, LOG)
+        finally:
+            if f is not None:
+                f.close()
+        pos = end
+    LOG.debug("Sent %s" % transfer)
+
+
+def write_all(f: io.FileIO, data, position: int = None) -> int:
+    """ Writes all the data to the file at the current position, or
+    at the given position (using pwrite(), which does not use or change
+    the file position), taking care to handle partial writes
+    """
+    written = 0
+    while written < len(data):
+        if position is None:
+            written += f.write(data[written:])
+        else:
+            written += os.pwrite(f.fileno(), data[written:], position + written)
+    return written
+
+
+def receive_data(connector: Connector, f: io.FileIO, length: int, buf: memoryview,
+                 transfer, fsync: bool = False, position: int = None):
+    """ Reads 'length' bytes from UNICORE/X, and writes them to the file
+    at the current or the given position (calling fsync() after each
+    block if requested)
+    """
+    remaining = length
+    while remaining > 0:
+        bytes_read = connector.read_data_into(buf[:min(remaining, transfer.block_size)])
+        if not bytes_read:
+            raise IOError("Data channel closed, %d bytes missing" % remaining)
+        remaining -= bytes_read
+        transfer.record(bytes_read)
+        write_all(f, buf[:bytes_read], position)
+        if position is not None:
+            position += bytes_read
+        if fsync:
+            os.fsync(f.fileno())
+
+
+# holes smaller than this are sent as data
+MIN_HOLE_SIZE = 65536
+
+# maximum number of data extents of a sparse transfer
+MAX_EXTENTS = 4096
+
+
+def get_data_extents(f: io.FileIO, start: int, length: int) -> list:
+    """ Finds the data in the given range of the file using SEEK_DATA and
+    SEEK_HOLE. Returns a list of (offset, length) extents relative to
+    'start', or None if the file system does not support finding holes
+    """
+    fd = f.fileno()
+    end = start + length
+    extents = []
+    pos = start
+    try:
+        while pos < end:
+            try:
+                data = os.lseek(fd, pos, os.SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO:
+                    # only a hole up to the end of the file
+                    break
+                raise
+            if data >= end:
+                break
+            hole = min(os.lseek(fd, data, os.SEEK_HOLE), end)
+            if len(extents) > 0 and data - extents[-1][1] < MIN_HOLE_SIZE:
+                extents[-1][1] = hole
+            else:
+                extents.append([data, hole])
+            pos = hole
+    except (OSError, AttributeError):
+        return None
+    return [(s - start, e - s) for s, e in extents]
+
+
+def get_extents(msg: str, length: int) -> list:
+    """ Returns the (offset, length) data extents given as
+    '#TSI_EXTENT <offset> <length>' lines in the message.
+    Raises a ValueError if they are not ordered or exceed the total length
+    """
+    extents = []
+    end = 0
+    for line in msg.splitlines():
+        if line.startswith("#TSI_EXTENT "):
+            offset, extent_length = [int(x) for x in line[len("#TSI_EXTENT "):].split(" ")]
+            if offset < end or extent_length < 0 or offset + extent_length > length:
+                raise ValueError("Invalid extent '%s'" % line)
+            extents.append((offset, extent_length))
+            end = offset + extent_length
+    return extents
+
+
+# compression modes supported for the data channel
+COMPRESSION_MODES = ["zlib"]
+
+
+def get_compression(msg: str, config: dict) -> str:
+    """ Returns the compression mode requested by UNICORE/X ('#TSI_COMPRESSION'),
+    or None if none was requested, it is not supported or disabled
+    """
+    mode = extract_parameter(msg, "COMPRESSION")
+    if mode is None or not config.get('tsi.io.compression', True):
+        return None
+    mode = mode.strip().lower()
+    if mode not in COMPRESSION_MODES:
+        return None
+    return mode
+
+
+def is_compressible(f: io.FileIO, start: int, length: int, config: dict) -> bool:
+    """ Checks whether the first block of the data compresses well enough
+    to be worth compressing the data
+    """
+    sample = os.pread(f.fileno(), min(length, 65536), start)
+    if len(sample) == 0:
+        return False
+    level = int(config.get('tsi.io.compression_level', 1))
+    return len(zlib.compress(sample, level)) < 0.9 * len(sample)
+
+
+def send_compressed(connector: Connector, f: io.FileIO, start: int, length: int,
+                    config: dict, transfer) -> int:
+    """ Sends 'length' bytes of the file as a zlib stream, padding with
+    zeros if the file was truncated in the meantime.
+    Returns the number of (compressed) bytes sent
+    """
+    compressor = zlib.compressobj(int(config.get('tsi.io.compression_level', 1)))
+    buf = get_buffer(config, transfer.max_block_size)
+    f.seek(start)
+    remaining = length
+    sent = 0
+    while remaining > 0:
+        size = min(remaining, transfer.block_size)
+        read = f.readinto(buf[:size])
+        if read == 0:
+            # the file was truncated
+            read = size
+            buf[:read] = bytes(read)
+        remaining -= read
+        transfer.record(read)
+        data = compressor.compress(buf[:read])
+        if len(data) > 0:
+            sent += connector.write_data(data)
+    sent += connector.write_data(compressor.flush())
+    return sent
+
+
+def receive_compressed(connector: Connector, f: io.FileIO, length: int,
+                       buf: memoryview, transfer, fsync: bool = False, position: int = None):
+    """ Reads a zlib stream from UNICORE/X, writing the
+    'length' bytes of decompressed data to the file at the current
+    or the given position (calling fsync() after each block if requested).
+    Since the length of the compressed data is not known, only the data
+    that is available is read, to not wait for more data than UNICORE/X
+    sends.
+    """
+    decompressor = zlib.decompressobj()
+    remaining = length
+    while not decompressor.eof:
+        bytes_read = connector.read_available_data_into(buf[:transfer.block_size])
+        if not bytes_read:
+            raise IOError("Data channel closed, %d bytes missing" % remaining)
+        data = buf[:bytes_read]
+        # limit the size of the decompressed blocks
+        while len(data) > 0 and not decompressor.eof:
+            chunk = decompressor.decompress(data, transfer.max_block_size)
+            remaining -= len(chunk)
+            if remaining < 0:
+                raise IOError("Received more than %d bytes of data" % length)
+            transfer.record(len(chunk))
+            write_all(f, chunk, position)
+            if position is not None:
+                position += len(chunk)
+            if fsync:
+                os.fsync(f.fileno())
+            data = decompressor.unconsumed_tail
+    if len(decompressor.unused_data) > 0:
+        raise IOError("Received unexpected data after the compressed data")
+    if remaining > 0:
+        raise IOError("Compressed data ended, %d bytes missing" % remaining)
+
+
+# prefix of the extended attributes used to cache checksums
+CHECKSUM_XATTR = "user.unicore.checksum."
+
+
+def get_cached_checksum(path: str, algorithm: str, file_info: os.stat_result) -> str:
+    """ Returns the digest cached in the extended attributes of the file,
+    if it is still valid for the current size and modification time
+    """
+    try:
+        value = os.getxattr(path, CHECKSUM_XATTR + algorithm).decode("UTF-8")
+        size, mtime, digest = value.split(" ")
+        if int(size) == file_info.st_size and int(mtime) == file_info.st_mtime_ns:
+            return digest
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def set_cached_checksum(path: str, algorithm: str, file_info: os.stat_result, digest: str):
+    """ Stores the digest in the extended attributes of the file (ignoring failure) """
+    value = "%d %d %s" % (file_info.st_size, file_info.st_mtime_ns, digest)
+    try:
+        os.setxattr(path, CHECKSUM_XATTR + algorithm, value.encode("UTF-8"))
+    except OSError:
+        pass
+
+
+def compute_checksums(f: io.FileIO, start: int, length: int, algorithms: list, buf: memoryview) -> dict:
+    """ Reads 'length' bytes (or up to the end of the file if length < 0)
+    from the given position, computing the digests for all the given
+    algorithms in a single pass
+    """
+    hashes = {a: hashlib.new(a) for a in algorithms}
+    try:
+        os.posix_fadvise(f.fileno(), start, max(0, length), os.POSIX_FADV_SEQUENTIAL)
+    except (OSError, AttributeError):
+        pass
+    f.seek(start)
+    remaining = length
+    while remaining != 0:
+        size = len(buf) if remaining < 0 else min(len(buf), remaining)
+        read = f.readinto(buf[:size])
+        if read == 0:
+            break
+        for h in hashes.values():
+            h.update(buf[:read])
+        if remaining > 0:
+            remaining -= read
+    return {a: h.hexdigest() for a, h in hashes.items()}
+
+
+def checksum(msg: str, connector: Connector, config: dict, LOG: Logger):
+    """ Computes checksums of a file without sending its content.
+       The message sent by UNICORE/X is scanned for:
+           TSI_FILE       - name of the file
+           TSI_ALGORITHMS - comma-separated list of hash algorithms
+                            (optional, default: MD5)
+           TSI_START      - start byte (optional)
+           TSI_LENGTH     - how many bytes to read (optional, default:
+                            up to the end of the file)
+       Replies with one '<algorithm> <hex digest>' line per algorithm,
+       followed by 'ENDOFMESSAGE'.
+       Digests of whole files are optionally cached in extended
+       attributes of the file ('tsi.checksum.xattr_cache')
+    """
+    path = expand_variables(extract_parameter(msg, 'FILE'))
+    requested = [a.strip() for a in extract_parameter(msg, 'ALGORITHMS', "MD5").split(",")
+                 if len(a.strip()) > 0]
+    start = max(0, extract_number(msg, 'START'))
+    length = extract_number(msg, 'LENGTH')
+    # accept e.g. 'SHA-256' as well as 'sha256'
+    algorithms = {a: a.lower().replace("-", "") for a in requested}
+    for name, algorithm in algorithms.items():
+        # variable length digests (SHAKE) are not supported
+        if algorithm not in hashlib.algorithms_available or hashlib.new(algorithm).digest_size == 0:
+            connector.failed("Unsupported checksum algorithm '%s'" % name)
+            return
+    use_cache = config.get('tsi.checksum.xattr_cache', False) and start == 0 and length < 0
+
+    with io.FileIO(path, "rb") as f:
+        file_info = os.fstat(f.fileno())
+        digests = {}
+        if use_cache:
+            for algorithm in set(algorithms.values()):
+                digest = get_cached_checksum(path, algorithm, file_info)
+                if digest is not None:
+                    digests[algorithm] = digest
+        missing = [a for a in set(algorithms.values()) if a not in digests]
+        if len(missing) > 0:
+            buf = get_buffer(config, int(config.get('tsi.io.buffer_size', 1048576)))
+            LOG.debug("Computing %s for %s" % (missing, path))
+            computed = compute_checksums(f, start, length, missing, buf)
+            digests.update(computed)
+            if use_cache:
+                after = os.fstat(f.fileno())
+                if (after.st_size, after.st_mtime_ns) == (file_info.st_size, file_info.st_mtime_ns):
+                    for algorithm, digest in computed.items():
+                        set_cached_checksum(path, algorithm, file_info, digest)
+
+    with connector.reply():
+        connector.ok()
+        for name, algorithm in algorithms.items():
+            connector.write_message("%s %s" % (name, digests[algorithm]))
+
+
+def get_buffer(config: dict, size: int) -> memoryview:
+    """ Returns a buffer of at least the given size for receiving data
+    from UNICORE/X, which is re-used for later transfers
+    """
+    buf = config.get('tsi.io.buffer')
+    if buf is None or len(buf) < size:
+        buf = memoryview(bytearray(size))
+        config['tsi.io.buffer'] = buf
+    return buf
+
+
+def preallocate(f: io.FileIO, length: int, LOG: Logger, position: int = None):
+    """ Allocates disk space for 'length' bytes to be written at the
+    given (or the current) position, extending the file if necessary
+    (ignoring failure)
+    """
+    if position is None:
+        position = f.tell()
+    try:
+        os.posix_fallocate(f.fileno(), position, length)
+    except OSError as e:
+        LOG.debug(f"Cannot preallocate: {repr(e)}")
+
 _mode_table = (
     (stat.S_IRUSR, "r"),
     (stat.S_IWUSR, "w"),
@@ -118,7 +642,64 @@ _mode_table = (
 )
 
 
-def get_info(path):
+def get_identity():
+    """ Returns the effective uid and the set of effective gids,
+    used to compute access permissions (see get_access())
+    """
+    return os.geteuid(), set([os.getegid()] + os.getgroups())
+
+
+def get_access(statinfo: os.stat_result, identity) -> tuple:
+    """ Computes whether the file is readable, writable and executable
+    for the given identity (effective uid, set of gids) from the file's
+    stat information, instead of calling access() for each of them.
+    Like access(), root may read and write everything and execute
+    directories and files with any execute bit.
+    ACLs are not taken into account.
+    """
+    uid, gids = identity
+    mode = statinfo.st_mode
+    if uid == 0:
+        executable = stat.S_ISDIR(mode) or (mode & 0o111) != 0
+        return True, True, executable
+    if uid == statinfo.st_uid:
+        bits = (mode >> 6) & 0o7
+    elif statinfo.st_gid in gids:
+        bits = (mode >> 3) & 0o7
+    else:
+        bits = mode & 0o7
+    return bits & 0o4 != 0, bits & 0o2 != 0, bits & 0o1 != 0
+
+
+def get_user_name(uid: int, user_cache: UserCache = None) -> str:
+    """ Returns the name of the user, or the uid if it cannot be resolved """
+    if user_cache is not None:
+        name = user_cache.get_name_4uid(uid)
+    else:
+        try:
+            name = pwd.getpwuid(uid).pw_name
+        except KeyError:
+            name = None
+    if name is None:
+        name = str(uid)
+    return name
+
+
+def get_group_name(gid: int, user_cache: UserCache = None) -> str:
+    """ Returns the name of the group, or the gid if it cannot be resolved """
+    if user_cache is not None:
+        name = user_cache.get_name_4gid(gid)
+    else:
+        try:
+            name = grp.getgrgid(gid).gr_name
+        except KeyError:
+            name = None
+    if name is None:
+        name = str(gid)
+    return name
+
+
+def get_info(path: str, statinfo: os.stat_result = None, identity = None, user_cache: UserCache = None):
     """" TSI_LS listing for a single file. The format is:
 
       Character 0 is usually blank, except:
@@ -154,27 +735,32 @@ def get_info(path):
      Every line is terminated by \n
     """
 
-    statinfo = os.stat(path)
+    if statinfo is None:
+        statinfo = os.stat(path)
+    if identity is None:
+        identity = get_identity()
     mode = statinfo.st_mode
 
     is_dir = " "
     if stat.S_ISDIR(mode):
         is_dir = "D"
 
+    readable, writable, executable = get_access(statinfo, identity)
+
     is_read = " "
-    if os.access(path, os.R_OK):
+    if readable:
         is_read = "R"
 
     is_write = " "
-    if os.access(path, os.W_OK):
+    if writable:
         is_write = "W"
 
     is_exec = " "
-    if os.access(path, os.X_OK):
+    if executable:
         is_exec = "X"
 
     is_own = " "
-    if os.geteuid() == statinfo.st_uid:
+    if identity[0] == statinfo.st_uid:
         is_own = "O"
 
     p = []
@@ -193,35 +779,147 @@ def get_info(path):
     # careful with newline chars: replace by '?'
     path = re.sub(r'[\r\n]', '?', path)
 
-    pwd_entry = pwd.getpwuid(statinfo.st_uid)
-    if pwd_entry is not None:
-        user = pwd_entry.pw_name
-    else:
-        user = str(statinfo.st_uid)
-
-    grp_entry = grp.getgrgid(statinfo.st_gid)
-    if grp_entry is not None:
-        group = grp_entry.gr_name
-    else:
-        group = str(statinfo.st_gid)
+    user = get_user_name(statinfo.st_uid, user_cache)
+    group = get_group_name(statinfo.st_gid, user_cache)
 
     return " " + is_dir + is_read + is_write + is_exec + is_own + " " + size \
            + " " + modt + " " + path + "\n" + perms + " " + user + " " + group
 
 
-def list_directory(connector: Connector, path: str, recursive: bool):
-    """ List a directory (which is supposed to exist) """
-    entries = os.listdir(path)
-    for entry in entries:
-        full_path = os.path.join(path, entry)
-        if recursive and os.path.isdir(full_path):
-            list_directory(connector, full_path, recursive)
-            connector.write_message("<")
+def _stat(entry: os.DirEntry):
+    """ Returns the stat result of the entry, or None on error """
+    try:
+        return entry.stat()
+    except OSError:
+        return None
+
+
+def _is_dir(entry: os.DirEntry) -> bool:
+    try:
+        return entry.is_dir()
+    except OSError:
+        return False
+
+
+def _scan(path: str, executor: ThreadPoolExecutor = None) -> list:
+    """ Reads the directory, returning a list of the entries and their
+    stat results. With an executor, the stat() calls are submitted to
+    it, and the list contains futures instead of stat results
+    """
+    with os.scandir(path) as it:
+        entries = list(it)
+    if executor is None:
+        return [(entry, _stat(entry)) for entry in entries]
+    return [(entry, executor.submit(_stat, entry)) for entry in entries]
+
+
+def _iterate(listing: list, recursive: bool, executor: ThreadPoolExecutor = None):
+    """ Yields (path, stat result, listing of the sub-directory or None)
+    for the entries of a listing created by _scan().
+    With an executor, the sub-directories are read ahead of time
+    """
+    prefetched = {}
+    if executor is not None and recursive:
+        for entry, _ in listing:
+            if _is_dir(entry):
+                prefetched[entry.path] = executor.submit(_scan, entry.path, executor)
+    for entry, statinfo in listing:
+        if executor is not None:
+            statinfo = statinfo.result()
+        if statinfo is None:
+            continue
+        sub_listing = None
+        if recursive and stat.S_ISDIR(statinfo.st_mode):
+            future = prefetched.pop(entry.path, None)
+            if future is not None:
+                sub_listing = future.result()
+            else:
+                sub_listing = _scan(entry.path, executor)
+        yield entry.path, statinfo, sub_listing
+
+
+def _write_info(connector: Connector, path: str, statinfo: os.stat_result, identity,
+                user_cache: UserCache = None):
+    try:
+        connector.write_message(get_info(path, statinfo, identity, user_cache))
+    except:
+        pass
+
+
+def list_directory(connector: Connector, path: str, recursive: bool, identity = None,
+                   user_cache: UserCache = None, threads: int = 0):
+    """ List a directory (which is supposed to exist)
+
+    Sub-directories are listed depth-first, using an explicit stack
+    instead of recursion: the content of a sub-directory is followed by
+    a "<" line and the entry for the sub-directory itself.
+    With threads > 0, a pool of threads reads directories and stats
+    the entries ahead of time (to hide the metadata latency of parallel
+    file systems), while the output remains the same.
+    """
+    if identity is None:
+        identity = get_identity()
+    executor = None
+    if threads > 0:
+        executor = ThreadPoolExecutor(max_workers=threads)
+    try:
+        # stack of (entries iterator, (path, stat result) of the directory)
+        stack = [(_iterate(_scan(path, executor), recursive, executor), None)]
+        while len(stack) > 0:
+            entries, directory = stack[-1]
+            item = next(entries, None)
+            if item is None:
+                stack.pop()
+                if directory is not None:
+                    connector.write_message("<")
+                    _write_info(connector, directory[0], directory[1], identity, user_cache)
+                continue
+            entry_path, statinfo, sub_listing = item
+            if sub_listing is not None:
+                stack.append((_iterate(sub_listing, recursive, executor), (entry_path, statinfo)))
+            else:
+                _write_info(connector, entry_path, statinfo, identity, user_cache)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+
+def get_sorted_names(path: str, config: dict) -> list:
+    """ Returns the sorted list of names in the directory. The list is
+    cached (for the current user) as long as the directory is not
+    modified, so paging through a large directory is cheap.
+    At most 'tsi.ls_cache_size' lists are kept.
+    """
+    cache = config.get('tsi.ls_cache', {})
+    config['tsi.ls_cache'] = cache
+    key = (os.geteuid(), path)
+    mtime = os.stat(path).st_mtime_ns
+    entry = cache.pop(key, None)
+    if entry is None or entry[0] != mtime:
+        entry = (mtime, sorted(os.listdir(path)))
+    cache[key] = entry
+    while len(cache) > int(config.get('tsi.ls_cache_size', 4)):
+        del cache[next(iter(cache))]
+    return entry[1]
+
+
+def list_directory_page(connector: Connector, path: str, offset: int, limit: int,
+                        config: dict, user_cache: UserCache = None) -> int:
+    """ List (at most) 'limit' entries of a directory, sorted by name,
+    starting at 'offset'. A negative limit lists all remaining entries.
+    Returns the total number of entries in the directory.
+    """
+    identity = get_identity()
+    names = get_sorted_names(path, config)
+    end = offset + limit if limit >= 0 else len(names)
+    for name in names[offset:end]:
         try:
-            file_info = get_info(full_path)
+            full_path = os.path.join(path, name)
+            file_info = get_info(full_path, None, identity, user_cache)
             connector.write_message(file_info)
         except:
             pass
+    return len(names)
 
 
 def ls(msg: str, connector: Connector, config: dict, LOG: Logger):
@@ -254,30 +952,159 @@ def ls(msg: str, connector: Connector, config: dict, LOG: Logger):
    continuing with the parent directory, a line with a single "<" is printed.
    This is required even when the listing is non-recursive.
 
+   Non-recursive listings can be paged using
+           TSI_LS_OFFSET - index of the first entry to list (default: 0)
+           TSI_LS_LIMIT  - maximum number of entries to list
+   In this case the entries are sorted by name, and the line
+   END_LISTING is followed by the line
+
+   TOTAL <total number of entries in the directory>
+
     """
     path = extract_parameter(msg, "FILE")
     path = expand_variables(path)
     mode = extract_parameter(msg, "LS_MODE")
+    offset = extract_number(msg, "LS_OFFSET")
+    limit = extract_number(msg, "LS_LIMIT")
+    paged = offset >= 0 or limit >= 0
 
     allowed = ["R", "A", "N"]
     if mode not in allowed:
         connector.failed("Unknown TSI_LS mode: '%s', must be one of "
                          "'R', 'A' or 'N'." % mode)
         return
+    if paged and mode != "N":
+        connector.failed("TSI_LS_OFFSET and TSI_LS_LIMIT can only be used "
+                         "with TSI_LS_MODE 'N'.")
+        return
 
     as_single_file = "A" == mode
     recurse = "R" == mode
-    connector.ok("START_LISTING")
-    if os.path.exists(path):
-        try:
-            if os.path.isdir(path) and not as_single_file:
-                list_directory(connector, path, recurse)
-            else:
-                info = get_info(path)
-                connector.write_message(info)
-        except OSError as e:
-            LOG.debug(repr(e))
-    connector.write_message("END_LISTING")
+    user_cache = config.get('tsi.user_cache')
+    with connector.reply():
+        connector.ok("START_LISTING")
+        total = 0
+        if os.path.exists(path):
+            try:
+                if os.path.isdir(path) and paged:
+                    total = list_directory_page(connector, path, max(offset, 0), limit,
+                                                config, user_cache)
+                elif os.path.isdir(path) and not as_single_file:
+                    threads = int(config.get('tsi.ls_threads', 0))
+                    list_directory(connector, path, recurse, user_cache=user_cache, threads=threads)
+                else:
+                    info = get_info(path, user_cache=user_cache)
+                    connector.write_message(info)
+                    total = 1
+            except OSError as e:
+                LOG.debug(repr(e))
+        connector.write_message("END_LISTING")
+        if paged:
+            connector.write_message("TOTAL %d" % total)
+
+
+def stat_many(msg: str, connector: Connector, config: dict, LOG: Logger):
+    """Get information about many files in a single request
+       The message sent by UNICORE/X contains one line
+           #TSI_STAT_FILE <file name>
+       per file.
+
+ The TSI replies with TSI_OK and the lines
+
+   START_LISTING
+   <entry for each file, in the order of the request>
+   END_LISTING
+
+   The entries have the format described in the get_info() method.
+   If a file cannot be accessed, its entry is a single line
+
+   !<error name> <file name>
+
+   for example "!ENOENT /path/to/missing_file"
+    """
+    paths = [expand_variables(line[len("#TSI_STAT_FILE "):]) for line in msg.splitlines()
+             if line.startswith("#TSI_STAT_FILE ")]
+    user_cache = config.get('tsi.user_cache')
+    identity = get_identity()
+    with connector.reply():
+        connector.ok("START_LISTING")
+        for path in paths:
+            try:
+                info = get_info(path, identity=identity, user_cache=user_cache)
+            except OSError as e:
+                error = errno.errorcode.get(e.errno, "EIO")
+                info = "!%s %s" % (error, re.sub(r'[\r\n]', '?', path))
+            connector.write_message(info)
+        connector.write_message("END_LISTING")
+
+
+def get_mount_point(path: str) -> str:
+    """ Returns the mount point of the file system containing the path """
+    path = os.path.realpath(path)
+    dev = os.stat(path).st_dev
+    while path != "/":
+        parent = os.path.dirname(path)
+        if os.stat(parent).st_dev != dev:
+            break
+        path = parent
+    return path
+
+
+def is_excluded(path: str, excluded: list) -> bool:
+    """ Returns True if the path is equal to or below one of the excluded paths """
+    for prefix in excluded:
+        prefix = prefix.rstrip("/")
+        if path == prefix or path.startswith(prefix + "/") or prefix == "":
+            return True
+    return False
+
+
+def get_free_space(mount_point: str, config: dict):
+    """ Returns the total and free space (in bytes) of the file system,
+    cached per mount point for 'tsi.df.cache_ttl' seconds
+    """
+    ttl = int(config.get('tsi.df.cache_ttl', 60))
+    cache = config.get('tsi.df_cache', {})
+    config['tsi.df_cache'] = cache
+    now = time.time()
+    entry = cache.get(mount_point)
+    if entry is None or now - entry[0] > ttl:
+        st = os.statvfs(mount_point)
+        entry = (now, st.f_blocks * st.f_frsize, st.f_bavail * st.f_frsize)
+        if ttl > 0:
+            cache[mount_point] = entry
+    return entry[1], entry[2]
+
+
+def get_user_quota(mount_point: str, config: dict, LOG: Logger) -> str:
+    """ Returns the space available to the current user on the file system
+    as reported by the (optional) 'tsi.df.quota_cmd', or '-1'.
+    Any '%s' in the command is replaced by the (quoted) mount point.
+    The output is cached per user and mount point for 'tsi.df.cache_ttl' seconds
+    """
+    quota_cmd = config.get('tsi.df.quota_cmd')
+    if not quota_cmd:
+        return '-1'
+    ttl = int(config.get('tsi.df.cache_ttl', 60))
+    cache = config.get('tsi.quota_cache', {})
+    config['tsi.quota_cache'] = cache
+    key = (os.geteuid(), mount_point)
+    now = time.time()
+    entry = cache.get(key)
+    if entry is None or now - entry[0] > ttl:
+        user = '-1'
+        (success, result) = run_command(quota_cmd.replace("%s", shlex.quote(mount_point)),
+                                        login_shell=config.get('tsi.use_login_shell', True),
+                                        config=config)
+        m = re.search(r"\d+", result) if success else None
+        if m is not None:
+            user = m.group(0)
+        else:
+            LOG.debug("Wrong or unexpected output from quota command: %s" % result)
+        entry = (now, user)
+        if ttl > 0:
+            cache[key] = entry
+    return entry[1]
 
 
 def df(msg: str, connector: Connector, config: dict, LOG: Logger):
@@ -295,34 +1122,27 @@ def df(msg: str, connector: Connector, config: dict, LOG: Logger):
     - FREE: The free space on the partition
     - USER: The user quota (optional)
     Every line is terminated by \n
+
+    Paths listed in 'tsi.df.exclude' are not checked, and
+    -1 is reported for all values.
     """
 
     path = extract_parameter(msg, "FILE")
     path = expand_variables(path)
-
-    # TODO might want to add a cache or do not check
-    # free space for certain paths
-
-    command = "df -P -B 1 %s" % path
-    (success, result) = run_command(command, login_shell=config.get('tsi.use_login_shell', True))
     total = free = user = '-1'
 
-    if success:
+    if not is_excluded(os.path.normpath(path), config.get('tsi.df.exclude', [])):
         try:
-            for line in result.splitlines():
-                m = re.match(r"(\S+)\s+(\d+)\s+(\d+)\s+(\d+).+", line)
-                if m is not None:
-                    total = m.group(2)
-                    free = m.group(4)
-        except Exception as e:
-            connector.failed("Wrong or unexpected output from 'df' "
-                             "command: %s" % result)
-            LOG.debug("Wrong or unexpected output from 'df' command: %s %s" % (result, repr(e)))
+            mount_point = get_mount_point(path)
+            total, free = get_free_space(mount_point, config)
+        except OSError as e:
+            connector.failed("Cannot get free space for '%s': %s" % (path, str(e)))
             return
+        user = get_user_quota(mount_point, config, LOG)
+
+    with connector.reply():
         connector.ok("START_DF")
         connector.write_message("TOTAL %s" % total)
         connector.write_message("FREE %s" % free)
         connector.write_message("USER %s" % user)
-        connector.write_message("END_DF")
-    else:
-        connector.failed(result)
\ No newline at end of file
+        connector.write_message("END_DF")
\ No newline at end of file
@@ -0,0 +1,78 @@
+"""
+Parsed representation of a message sent by UNICORE/X
+"""
+
+
+class Message(str):
+    """ A message from UNICORE/X, which still behaves like the plain
+    string it was created from, but additionally holds an index of all
+    the '#TSI_<KEY> <value>' lines it contains, and the list of
+    commands, i.e. lines consisting only of '#TSI_<COMMAND>'.
+    The index is built once, in a single pass over the message, so
+    looking up parameters does not require scanning the message again.
+    """
+
+    def __new__(cls, message: str):
+        self = super().__new__(cls, message)
+        self.parameters, self.commands = self._index()
+        return self
+
+    def _index(self):
+        """ Collects the '#TSI_<KEY> <value>\\n' and '#TSI_<COMMAND>\\n'
+        lines. As with the original regular expression based lookup, only
+        lines starting with '#TSI_' and terminated by a newline are
+        considered, and the first occurrence of a key wins.
+        Commands are returned in the order of their appearance,
+        including the 'TSI_' prefix.
+        """
+        parameters = {}
+        commands = []
+        pos = 0 if self.startswith("#TSI_") else self._next_line(0)
+        while pos >= 0:
+            end = self.find("\n", pos)
+            if end < 0:
+                break
+            key, sep, value = self[pos + 5:end].partition(" ")
+            if sep:
+                if key not in parameters:
+                    parameters[key] = value
+            elif key:
+                commands.append("TSI_" + key)
+            pos = self._next_line(end)
+        return parameters, commands
+
+    def _next_line(self, start: int) -> int:
+        """ Returns the start of the next '#TSI_' line after 'start', or -1 """
+        pos = self.find("\n#TSI_", start)
+        if pos >= 0:
+            pos += 1
+        return pos
+
+    def get(self, parameter: str, default_value: str = None) -> str:
+        """ Returns the value of '#TSI_<parameter>', or the default value
+        if it is not present or empty.
+        """
+        value = self.parameters.get(parameter)
+        if not value:
+            value = default_value
+        return value
+
+    def get_number(self, parameter: str, default_value: int = -1) -> int:
+        """ Returns the value of '#TSI_<parameter>' as an integer, or
+        the default value if it is not given or not a number.
+        """
+        try:
+            return int(float(self.parameters[parameter]))
+        except:
+            return default_value
+
+    def has(self, parameter: str) -> bool:
+        """ Returns True if '#TSI_<parameter>' has a non-empty value """
+        return bool(self.parameters.get(parameter))
+
+
+def parse(message: str) -> Message:
+    """ Returns the message as a Message, parsing it only if required """
+    if isinstance(message, Message):
+        return message
+    return Message(message)
@@ -5,7 +5,8 @@
 #  - if validated, command and data connections are opened
 #    via callback to UNICORE/X
 #  - a child process is forked which further communicates
-#    with UNICORE/X via the command/data sockets
+#    with UNICORE/X via the command/data sockets, or the sockets
+#    are handed to an idle worker from the pool of pre-forked workers
 
 import errno
 import os
@@ -13,8 +14,22 @@ import signal
 import socket
 import sys
 import time
+import WorkerPool
 from Log import Logger
 
+def set_buffer_sizes(sock: socket.socket, config: dict):
+    """
+    Set the socket buffer sizes, if configured. To be effective,
+    this must be done before the socket is connected, since the TCP
+    window scaling is negotiated when the connection is established.
+    """
+    for option, key in [(socket.SO_SNDBUF, 'tsi.socket.send_buffer'),
+                        (socket.SO_RCVBUF, 'tsi.socket.receive_buffer')]:
+        size = int(config.get(key, 0))
+        if size > 0:
+            sock.setsockopt(socket.SOL_SOCKET, option, size)
+
+
 def configure_socket(sock: socket.socket):
     """
     Setup socket options (keepalive).
@@ -70,7 +85,9 @@ def connect(config: dict, LOG: Logger):
     'newtsiprocess <ux-port>'
         Callback to UNICORE/X and open a pair (command,data) of sockets
         for communicating with UNICORE/X, fork a new process,
-        and return the socket pair to the main loop for user command processing
+        and return the socket pair to the main loop for user command processing.
+        If the worker pool is enabled ('tsi.worker_pool.size' > 0), the
+        socket pair is handed to an idle pre-forked worker instead
 
     'start-forwarding <ux-port> <service_spec> <user> <group>'
         Connect to the given service, callback to U/X to open a socket,
@@ -113,7 +130,18 @@ def connect(config: dict, LOG: Logger):
     LOG.info("SSL enabled: %s" % ssl_mode)
     server.listen(2)
 
+    pool = None
+    if int(config.get('tsi.worker_pool.size', 0)) > 0:
+        pool = WorkerPool.WorkerPool(config, LOG)
+        LOG.info("Using pool of %s pre-forked workers" % pool.size)
+
     while True:
+        if pool is not None:
+            session = pool.maintain(server)
+            if session is not None:
+                return session[0], session[1], None
+            if not pool.wait(server):
+                continue
         try:
             (unicorex, peer_info) = server.accept()
             unicorex_host = peer_info[0]
@@ -140,6 +168,8 @@ def connect(config: dict, LOG: Logger):
             continue
 
         configure_socket(unicorex)
+        # don't let a stalled peer block the main process forever
+        unicorex.settimeout(10)
         try:
             msg = unicorex.recv(1024)
             msg = str(msg, "UTF-8").strip()
@@ -178,37 +208,39 @@ def connect(config: dict, LOG: Logger):
         try:
             # write to UNICORE/X to tell it everything is OK
             unicorex.sendall(b'OK\n')
-            # callback to UNICORE/X
             unicorex_port = get_unicorex_port(config, params)
             if unicorex_port is None:
                 raise EnvironmentError("Received invalid message")
-            address = (unicorex_host, unicorex_port)
-            LOG.info("Contacting UNICORE/X on %s port %s" % address)
-            # allow some time for U/X to start listening
-            time.sleep(1)
-            xnjs_sockets = []
-            for _ in range(0, num_conns):
-                new_socket = open_connection(address, 10, config)
-                if ssl_mode:
-                    new_socket = setup_ssl(config, new_socket, LOG, server_mode=False)
-                configure_socket(new_socket)
-                xnjs_sockets.append(new_socket)
         except EnvironmentError as e:
-            LOG.info("Error creating connections to UNICORE/X : %s" % str(e))
+            LOG.info("Error handling request from UNICORE/X : %s" % str(e))
             close_quietly(unicorex)
             continue
         close_quietly(unicorex)
-        LOG.info("Connection to UNICORE/X at %s:%s established." % address)
+        address = (unicorex_host, unicorex_port)
+        # the callback to UNICORE/X is done by the worker, so the
+        # main process can immediately accept the next request
+        local_port = reserve_local_ports(config, num_conns)
+        if pool is not None and cmd == "newtsiprocess":
+            if pool.dispatch(address, local_port):
+                continue
+            LOG.info("No idle pooled worker available.")
         worker_id = config.get('tsi.worker.id', 1)
         LOG.info("Starting tsi-worker-%d" % worker_id)
 
-        # fork, cleanup and return sockets to the caller (main loop)
+        # fork, callback, and return sockets to the caller (main loop)
         pid = os.fork()
         if pid == 0:
             # child
             server.close()
+            if pool is not None:
+                pool.close()
             # reset signal handler
             signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            try:
+                xnjs_sockets = callback(address, num_conns, local_port, config, LOG)
+            except EnvironmentError as e:
+                LOG.info("Error creating connections to UNICORE/X : %s" % str(e))
+                os._exit(1)
             if cmd == "newtsiprocess":
                 command = xnjs_sockets[0]
                 data = xnjs_sockets[1]
@@ -221,11 +253,105 @@ def connect(config: dict, LOG: Logger):
                 return xnjs_sockets[0], None, msg
         else:
             # parent
-            for i in range(0, num_conns):
-                xnjs_sockets[i].close()
             config['tsi.worker.id'] = worker_id + 1
 
 
+def callback(address, num_conns: int, local_port: int, config: dict, LOG: Logger) -> list:
+    """ Call back to UNICORE/X and open the requested number of
+        connections, setting up SSL if required.
+        Since UNICORE/X might not be listening yet, refused connections
+        are retried with increasing delays, for up to
+        'tsi.callback_timeout' seconds
+    """
+    LOG.info("Contacting UNICORE/X on %s port %s" % address)
+    ssl_mode = config.get('tsi.keystore') is not None
+    if ssl_mode:
+        from SSL import setup_ssl
+    port_range = config['tsi.local_portrange']
+    config['tsi.local_portrange'] = (local_port, port_range[1], port_range[2])
+    max_wait = float(config.get('tsi.callback_timeout', 10))
+    xnjs_sockets = []
+    try:
+        for _ in range(0, num_conns):
+            new_socket = connect_with_retry(address, max_wait, config)
+            xnjs_sockets.append(new_socket)
+            if ssl_mode:
+                new_socket = setup_ssl(config, new_socket, LOG, server_mode=False)
+                xnjs_sockets[-1] = new_socket
+            configure_socket(new_socket)
+    except EnvironmentError as e:
+        for s in xnjs_sockets:
+            close_quietly(s)
+        raise e
+    LOG.info("Connection to UNICORE/X at %s:%s established." % address)
+    return xnjs_sockets
+
+
+def connect_with_retry(address, max_wait: float, config: dict):
+    """ Connect to the given address, retrying with exponential
+        backoff (up to a total of 'max_wait' seconds) while the
+        connection is refused
+    """
+    delay = 0.05
+    start = time.time()
+    while True:
+        try:
+            return open_connection(address, 10, config)
+        except ConnectionRefusedError as e:
+            if time.time() - start + delay > max_wait:
+                raise e
+            time.sleep(delay)
+            delay = min(2 * delay, 1.0)
+
+
+def reserve_local_ports(config: dict, num_conns: int) -> int:
+    """ If a local port range is configured, return the first local
+        port for the next callback and advance the range by the number of
+        connections, so concurrent callbacks do not start at the same port
+    """
+    local_port, _lower, _upper = config['tsi.local_portrange']
+    if local_port > 0:
+        next_port = local_port + num_conns
+        if next_port > _upper:
+            next_port = _lower + (next_port - _upper - 1)
+        config['tsi.local_portrange'] = (next_port, _lower, _upper)
+    return local_port
+
+
+def next_session(config: dict, LOG: Logger):
+    """ For pooled workers, wait for the next session and return
+        its (command, data) sockets. Returns (None, None) if the
+        worker should exit.
+    """
+    pool = config.get('tsi.worker_pool')
+    if pool is None:
+        return None, None
+    LOG.info("Session finished, waiting for the next one.")
+    return pool.next_session()
+
+
+def create_connection(address, timeout, source_address, config: dict) -> socket.socket:
+    """ Like socket.create_connection(), but sets the configured
+        buffer sizes before connecting
+    """
+    host, port = address
+    error = OSError("Cannot resolve %s" % host)
+    for family, socktype, proto, _, sockaddr in socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM):
+        sock = None
+        try:
+            sock = socket.socket(family, socktype, proto)
+            set_buffer_sizes(sock, config)
+            sock.settimeout(timeout)
+            sock.bind(source_address)
+            sock.connect(sockaddr)
+            return sock
+        except OSError as e:
+            error = e
+            if sock is not None:
+                sock.close()
+    raise error
+
+
 def open_connection(address, timeout, config):
     """ Connect to the given address """
     port_range = config['tsi.local_portrange']
@@ -240,7 +366,7 @@ def open_connection(address, timeout, config):
     attempts = 0
     while attempts<max_attempts:
         try:
-            sock = socket.create_connection(address, timeout, ('', local_port))
+            sock = create_connection(address, timeout, ('', local_port), config)
             if use_port_range:
                 local_port+=1
                 if local_port>_upper:
@@ -0,0 +1,200 @@
+"""
+Avoiding the cost of login shells when running commands
+
+Starting a new login shell for each command means that the system and
+user profiles are sourced every time, which can be slow. Two ways to
+avoid this are provided:
+
+ - a persistent shell: one long-lived login shell per identity (uid
+   and groups) is kept, which receives the commands via a pipe and runs
+   each of them in a subshell. The shell exits by itself after an idle
+   timeout.
+ - a cached login environment: the environment produced by a login
+   shell is captured once per identity and re-used (for a configurable
+   time) to run commands in a plain, non-login shell.
+"""
+
+import os
+import shlex
+import signal
+import subprocess
+import time
+import uuid
+
+# main loop of the shell: reads a '<token> <length>' line followed by
+# the command, runs the command in a subshell and writes the token
+# and the exit code after its output
+_DRIVER = r'''
+while IFS=" " read -r -t %d __tsi_token __tsi_len; do
+  LC_ALL=C IFS= read -r -N "$__tsi_len" __tsi_cmd
+  ( eval "$__tsi_cmd" ) < /dev/null 2>&1
+  printf "%%s %%d\n" "$__tsi_token" "$?"
+done
+'''
+
+
+class Shell(object):
+    """ A login shell co-process, running commands one after the other """
+
+    def __init__(self, idle_timeout: int):
+        self.idle_timeout = idle_timeout
+        # the shell itself waits a bit longer, to avoid a race with
+        # a command sent just before the timeout
+        driver = _DRIVER % (idle_timeout + 10)
+        self.process = subprocess.Popen(["/bin/bash", "-l", "-c", driver],
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT,
+                                        start_new_session=True)
+        self.last_used = time.time()
+        # skip any output of the login scripts
+        self.run(":")
+
+    def expired(self) -> bool:
+        """ Returns True if the shell has exited or has been idle too long """
+        if self.process.poll() is not None:
+            return True
+        return time.time() - self.last_used > self.idle_timeout
+
+    def run(self, cmd: str):
+        """ Runs the command in the current directory and with the current
+        umask of the TSI process, returning the exit code and the output
+        (stdout and stderr).
+        Raises an OSError if the shell exits before reporting the exit code.
+        """
+        umask = os.umask(0o22)
+        os.umask(umask)
+        cmd = "cd -- %s || exit 1\numask %03o\n%s" % (shlex.quote(os.getcwd()), umask, cmd)
+        token = uuid.uuid4().hex.encode("UTF-8")
+        data = cmd.encode("UTF-8")
+        self.process.stdin.write(b"%s %d\n%s" % (token, len(data), data))
+        self.process.stdin.flush()
+        marker = b"%s " % token
+        output = b""
+        pos = -1
+        while True:
+            chunk = os.read(self.process.stdout.fileno(), 65536)
+            if len(chunk) == 0:
+                raise OSError("Shell process exited")
+            start = max(0, len(output) - len(marker))
+            output += chunk
+            if pos < 0:
+                pos = output.find(marker, start)
+            if pos >= 0:
+                end = output.find(b"\n", pos)
+                if end >= 0:
+                    break
+        self.last_used = time.time()
+        exit_code = int(output[pos + len(marker):end])
+        return exit_code, output[:pos].decode("UTF-8")
+
+    def close(self):
+        """ Stops the shell and any processes it left running """
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=1)
+        except:
+            pass
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except:
+            pass
+        try:
+            self.process.wait(timeout=1)
+        except:
+            pass
+        self.process.stdout.close()
+
+
+def _identity():
+    return os.getuid(), os.getgid(), tuple(sorted(os.getgroups()))
+
+
+# variables that are set by the shell itself and must not be copied
+_SHELL_VARIABLES = ["PWD", "OLDPWD", "SHLVL", "_"]
+
+
+def _capture_environment() -> dict:
+    """ Returns the environment produced by a login shell """
+    # the marker separates the environment from any output of the login scripts
+    marker = "\0TSI_LOGIN_ENV\0"
+    raw_env = subprocess.check_output(["/bin/bash", "-l", "-c", "printf '\\0TSI_LOGIN_ENV\\0'; env -0"],
+                                      stdin=subprocess.DEVNULL,
+                                      stderr=subprocess.DEVNULL)
+    raw_env = raw_env.decode("UTF-8")
+    env = {}
+    for entry in raw_env[raw_env.rindex(marker) + len(marker):].split("\0"):
+        key, sep, value = entry.partition("=")
+        if sep and key not in _SHELL_VARIABLES:
+            env[key] = value
+    return env
+
+
+def get_login_environment(config: dict):
+    """ Returns the cached login environment for the current identity,
+    capturing it if required, or None if the command currently being
+    processed has to be run in a real login shell, because the cache
+    is disabled ('tsi.login_env.cache_ttl' is 0), the command is listed
+    in 'tsi.login_env.login_shell_commands', or the environment
+    cannot be captured.
+    """
+    ttl = int(config.get('tsi.login_env.cache_ttl', 0))
+    if ttl <= 0:
+        return None
+    if config.get('tsi.current_command') in config.get('tsi.login_env.login_shell_commands', []):
+        return None
+    envs = config.get('tsi.login_envs', {})
+    config['tsi.login_envs'] = envs
+    key = _identity()
+    now = time.time()
+    entry = envs.get(key)
+    if entry is None or now - entry[0] > ttl:
+        for k in [k for k, e in envs.items() if now - e[0] > ttl]:
+            del envs[k]
+        try:
+            entry = (now, _capture_environment())
+        except (OSError, ValueError, subprocess.CalledProcessError):
+            return None
+        envs[key] = entry
+    return entry[1]
+
+
+def run_command(cmd: str, config: dict):
+    """ Runs the command in the persistent login shell of the current
+    identity, starting the shell if required.
+    Returns the exit code and the output.
+    """
+    shells = config.get('tsi.shells', {})
+    config['tsi.shells'] = shells
+    key = _identity()
+    shell = shells.get(key)
+    if shell is not None and shell.expired():
+        shell.close()
+        shell = None
+    if shell is None:
+        idle_timeout = int(config.get('tsi.persistent_shell.idle_timeout', 300))
+        shell = Shell(idle_timeout)
+        shells[key] = shell
+    try:
+        return shell.run(cmd)
+    except OSError:
+        del shells[key]
+        shell.close()
+        raise
+
+
+def cleanup(config: dict):
+    """ Stops the shells that have exited or have been idle too long """
+    shells = config.get('tsi.shells', {})
+    for key, shell in list(shells.items()):
+        if shell.expired():
+            del shells[key]
+            shell.close()
+
+
+def close_all(config: dict):
+    """ Stops all the shells """
+    shells = config.get('tsi.shells', {})
+    for shell in shells.values():
+        shell.close()
+    shells.clear()
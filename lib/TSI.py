@@ -2,13 +2,15 @@
 Main TSI module, containing the main processing loop
 """
 
+import importlib
 import os
 import re
 import socket
 import sys
-import ACL, BecomeUser, BSS, PAM, Reservation, Server, IO, UFTP, Utils
-from Connector import Connector, Forwarder
+import ACL, Archive, BecomeUser, BSS, Copy, PAM, Reservation, Server, Shell, IO, Tail, UFTP, Utils
+from Connector import BatchConnector, Connector, Forwarder
 from Log import Logger
+from Message import Message, parse
 
 # TSI version
 MY_VERSION = "__VERSION__"
@@ -16,6 +18,20 @@ MY_VERSION = "__VERSION__"
 # minimum required Python version
 REQUIRED_VERSION = (3, 9, 0)
 
+# commands that spawn user processes (and may require a PAM session)
+SPAWNING_COMMANDS = ["TSI_EXECUTESCRIPT",
+                     "TSI_RUN_ON_LOGIN_NODE",
+                     "TSI_SUBMIT",
+                     "TSI_UFTP"]
+
+# commands that cannot be part of a '#TSI_BATCH'
+NON_BATCH_COMMANDS = ["TSI_BATCH",
+                      "TSI_GETFILECHUNK",
+                      "TSI_GETFILECHUNKS",
+                      "TSI_TAIL",
+                      "TSI_GET_ARCHIVE",
+                      "TSI_PUTFILECHUNK"]
+
 
 def assert_version():
     """
@@ -48,7 +64,35 @@ def get_default_config() -> dict:
     config['tsi.safe_dir'] = '/tmp'
     config['tsi.keyfiles'] = ['.ssh/authorized_keys']
     config['tsi.use_login_shell'] = True
+    config['tsi.persistent_shell'] = False
+    config['tsi.persistent_shell.idle_timeout'] = 300
+    config['tsi.login_env.cache_ttl'] = 0
+    config['tsi.login_env.login_shell_commands'] = ["TSI_EXECUTESCRIPT",
+                                                    "TSI_RUN_ON_LOGIN_NODE",
+                                                    "TSI_SUBMIT"]
     config['tsi.child_pids'] = []
+    config['tsi.plugins'] = []
+    config['tsi.reply_buffer_size'] = 65536
+    config['tsi.ls_cache_size'] = 4
+    config['tsi.ls_threads'] = 0
+    config['tsi.df.cache_ttl'] = 60
+    config['tsi.df.exclude'] = []
+    config['tsi.io.buffer_size'] = 1048576
+    config['tsi.io.adaptive_buffer'] = False
+    config['tsi.io.max_buffer_size'] = 16777216
+    config['tsi.socket.send_buffer'] = 0
+    config['tsi.socket.receive_buffer'] = 0
+    config['tsi.io.preallocate'] = False
+    config['tsi.io.fsync'] = 'none'
+    config['tsi.io.compression'] = True
+    config['tsi.io.compression_level'] = 1
+    config['tsi.tail.max_wait'] = 60
+    config['tsi.tail.poll_interval'] = 1
+    config['tsi.tail.max_length'] = 1048576
+    config['tsi.copy.progress_interval'] = 10
+    config['tsi.checksum.xattr_cache'] = False
+    config['tsi.worker_pool.size'] = 0
+    config['tsi.worker_pool.max_sessions'] = 100
     config['tsi.testing'] = False
     return config
 
@@ -66,7 +110,12 @@ def process_config_value(key: str, value: str, config: dict):
             'tsi.use_syslog',
             'tsi.debug',
             'tsi.disable_ipv6',
-            'tsi.use_login_shell'
+            'tsi.use_login_shell',
+            'tsi.persistent_shell',
+            'tsi.io.preallocate',
+            'tsi.io.adaptive_buffer',
+            'tsi.io.compression',
+            'tsi.checksum.xattr_cache'
     ]
     for bool_key in boolean_keys:
         if bool_key == key:
@@ -93,6 +142,15 @@ def process_config_value(key: str, value: str, config: dict):
             if len(v)>0:
                 kf.append(v)
         config["tsi.keyfiles"] = kf
+    elif key=="tsi.io.fsync":
+        if value not in ['none', 'end', 'always']:
+            raise KeyError("Invalid value '%s' for parameter '%s', "
+                           "must be 'none', 'end' or 'always'" % (value, key))
+        config[key] = value
+    elif key=="tsi.plugins":
+        config["tsi.plugins"] = [v.strip() for v in value.split(",") if len(v.strip())>0]
+    elif key=="tsi.login_env.login_shell_commands" or key=="tsi.df.exclude":
+        config[key] = [v.strip() for v in value.split(",") if len(v.strip())>0]
     elif key=="tsi.njs_machine":
         config["tsi_unicorex_machine"] = value
     elif key=="tsi_njs_port":
@@ -180,10 +238,28 @@ def read_config_file(file_name: str):
     return config
 
 
+def setup_plugins(config: dict, LOG: Logger):
+    """
+    Loads the (optional) plugin modules listed in 'tsi.plugins'.
+    Each plugin module must provide a function 'init_functions(config, LOG)'
+    returning a dictionary of additional commands ('TSI_...')
+    and the functions handling them
+    """
+    for name in config['tsi.plugins']:
+        try:
+            plugin = importlib.import_module(name)
+            for command, function in plugin.init_functions(config, LOG).items():
+                register_function(command, function, config)
+                LOG.info("Plugin %s: registered command %s" % (name, command))
+        except Exception as e:
+            raise Exception("Could not load plugin '%s': %s" % (name, str(e)))
+
+
 def finish_setup(config: dict, LOG: Logger):
     setup_acl(config, LOG)
     setup_allowed_ips(config, LOG)
     setup_portrange(config, LOG)
+    setup_plugins(config, LOG)
 
 
 def ping(connector: Connector):
@@ -193,16 +269,31 @@ def ping(connector: Connector):
 
 def ping_uid(msg: str, connector: Connector, config: dict, LOG: Logger):
     """ Returns TSI version and process' UID. Used for unit testing."""
-    connector.ok(MY_VERSION)
-    connector.write_message(" running as UID [%s]" % config.get('tsi.effective_uid', "n/a"))
+    with connector.reply():
+        connector.ok(MY_VERSION)
+        connector.write_message(" running as UID [%s]" % config.get('tsi.effective_uid', "n/a"))
+
+
+def get_identity(msg: str):
+    """ Returns the user and the list of groups given in the
+    '#TSI_IDENTITY <user> <groups>' line of the message, or None.
+    For a batch, only the header is considered.
+    """
+    message = parse(msg)
+    if "TSI_BATCH" in message.commands:
+        message = Message(("\n" + message).split("\n#TSI_BATCH_ITEM\n", 1)[0] + "\n")
+    id_info = (message.get("IDENTITY") or "").split()
+    if len(id_info) < 2:
+        return None
+    return id_info[0], id_info[1].split(":")
 
 
 def get_user_info(msg: str, connector: Connector, config: dict, LOG: Logger):
-    id_info = re.search(r".*#TSI_IDENTITY (\S+) (\S+)\n.*", msg, re.M)
+    id_info = get_identity(msg)
     if id_info is None:
         connector.failed("No user/group info given")
         return
-    user = id_info.group(1)
+    user = id_info[0]
     user_cache = config['tsi.user_cache']
     home = user_cache.get_home_4user(user)
     if home is None:
@@ -268,31 +359,98 @@ def execute_script(msg: str, connector: Connector, config: dict, LOG: Logger):
     discard = "#TSI_DISCARD_OUTPUT true\n" in msg
     child_pids = config['tsi.child_pids']
     use_login_shell = config.get('tsi.use_login_shell', True)
-    (success, output) = Utils.run_command(msg, discard, child_pids, use_login_shell)
+    (success, output) = Utils.run_command(msg, discard, child_pids, use_login_shell, config)
     if success:
         connector.ok(output)
     else:
         connector.failed(output)
 
+def batch(msg: str, connector: Connector, config: dict, LOG: Logger):
+    """ Runs a batch of commands, using a single user/group switch.
+    The message starts with the '#TSI_BATCH' header containing the
+    identity, followed by the sub-messages, each introduced by a
+    '#TSI_BATCH_ITEM' line. The sub-messages are processed in order.
+    The reply consists of one part per sub-message, starting with a line
+      TSI_BATCH_REPLY <index> <number of lines>
+    followed by the given number of lines of the sub-command's reply.
+    """
+    parts = ("\n" + msg).split("\n#TSI_BATCH_ITEM\n")
+    header = "".join(line + "\n" for line in parts[0].splitlines()
+                     if len(line.strip()) > 0 and line.strip() != "#TSI_BATCH")
+    functions = init_functions(config.get('tsi.bss', BSS.BSS()), config)
+    pam_enabled = config.get('tsi.open_user_sessions', False) and config.get('tsi.switch_uid', True)
+    batch_connector = BatchConnector(LOG)
+    connector.ok()
+    for index, item in enumerate(parts[1:]):
+        if not item.endswith("\n"):
+            item += "\n"
+        item_msg = Message(item)
+        sub_msg = Message(item + header)
+        command, function = get_function(sub_msg, functions)
+        os.chdir(config['tsi.safe_dir'])
+        try:
+            if function is None:
+                batch_connector.failed("Unknown #TSI_* command")
+            elif command in NON_BATCH_COMMANDS:
+                batch_connector.failed("Command %s cannot be used in a batch" % command)
+            elif pam_enabled and command in SPAWNING_COMMANDS:
+                batch_connector.failed("Command %s cannot be used in a batch "
+                                       "when user sessions are enabled" % command)
+            elif "IDENTITY" in item_msg.parameters:
+                batch_connector.failed("Batch items cannot set #TSI_IDENTITY")
+            elif "TSI_PING" == command:
+                ping(batch_connector)
+            else:
+                config['tsi.current_command'] = command
+                function(sub_msg, batch_connector, config, LOG)
+        except:
+            error = str(sys.exc_info()[1])
+            batch_connector.failed(error)
+            LOG.error("Error executing %s (batch item %d): %s" % (command, index, error))
+        reply = batch_connector.take_reply()
+        connector.write_message("TSI_BATCH_REPLY %d %d" % (index, reply.count("\n")))
+        if len(reply) > 0:
+            connector.write_message(reply[:-1])
+
+
 def start_forwarding(msg: str, forwarder: Forwarder, config: dict, LOG: Logger):
     """ starts forwarding threads """
     forwarder.start_forwarding()
 
 
-def init_functions(bss):
+def register_function(command: str, function, config: dict):
+    """
+    Registers an additional command ('TSI_...') and the function handling it.
+    The function is invoked like the built-in ones, i.e.
+    function(msg, connector, config, LOG)
+    """
+    functions = config.get('tsi.extra_functions', {})
+    functions[command] = function
+    config['tsi.extra_functions'] = functions
+
+
+def init_functions(bss, config: dict = None):
     """
     Creates the function lookup table used to map UNICORE/X commands
-    ('#TSI_...') to the appropriate TSI function.
+    ('#TSI_...') to the appropriate TSI function, including any commands
+    registered via register_function()
     """
-    return {
+    functions = {
         "TSI_PING": ping,
         "TSI_PING_UID": ping_uid,
         "TSI_GET_USER_INFO": get_user_info,
         "TSI_EXECUTESCRIPT": execute_script,
         "TSI_GETFILECHUNK": IO.get_file_chunk,
+        "TSI_GETFILECHUNKS": IO.get_file_chunks,
+        "TSI_TAIL": Tail.tail,
+        "TSI_GET_ARCHIVE": Archive.get_archive,
         "TSI_PUTFILECHUNK": IO.put_file_chunk,
         "TSI_LS": IO.ls,
+        "TSI_STAT_MANY": IO.stat_many,
+        "TSI_COPY": Copy.copy,
+        "TSI_MOVE": Copy.move,
         "TSI_DF": IO.df,
+        "TSI_CHECKSUM": IO.checksum,
         "TSI_UFTP": UFTP.uftp,
         "TSI_SUBMIT": bss.submit,
         "TSI_RUN_ON_LOGIN_NODE": bss.run_on_login_node,
@@ -308,16 +466,31 @@ def init_functions(bss):
         "TSI_QUERY_RESERVATION": Reservation.query_reservation,
         "TSI_CANCEL_RESERVATION": Reservation.cancel_reservation,
         "TSI_FILE_ACL": ACL.process_acl,
+        "TSI_BATCH": batch,
     }
+    if config is not None:
+        functions.update(config.get('tsi.extra_functions', {}))
+    return functions
+
+
+def get_function(message: Message, functions: dict):
+    """
+    Finds the command in the (parsed) message and looks up the
+    function handling it.
+    Returns a tuple (command, function), which are None if the message
+    does not contain a known command
+    """
+    for command in message.commands:
+        function = functions.get(command)
+        if function is not None:
+            return command, function
+    return None, None
 
 
 def handle_function(function, command: str, msg: str, connector: Connector, config: dict, LOG: Logger):
     switch_uid = config.get('tsi.switch_uid', True)
     pam_enabled = config.get('tsi.open_user_sessions', False)
-    cmd_spawns = command in [ "TSI_EXECUTESCRIPT",
-                             "TSI_RUN_ON_LOGIN_NODE",
-                             "TSI_SUBMIT",
-                             "TSI_UFTP" ]
+    cmd_spawns = command in SPAWNING_COMMANDS
     open_user_session = pam_enabled and cmd_spawns and switch_uid
     if open_user_session and command!="_START_FORWARDING":
         # fork to avoid TSI process getting put into user slice
@@ -327,11 +500,10 @@ def handle_function(function, command: str, msg: str, connector: Connector, conf
             return
     try:
         if switch_uid:
-            id_info = re.search(r".*#TSI_IDENTITY (\S+) (\S+)\n.*", msg, re.M)
+            id_info = get_identity(msg)
             if id_info is None:
                 raise RuntimeError("No user/group info given")
-            user = id_info.group(1)
-            groups = id_info.group(2).split(":")
+            user, groups = id_info
             if open_user_session:
                 pam_module = config.get('tsi.pam_module', "unicore-tsi")
                 pam_session = PAM.PAM(LOG, module_name=pam_module)
@@ -339,6 +511,7 @@ def handle_function(function, command: str, msg: str, connector: Connector, conf
             user_switch_status = BecomeUser.become_user(user, groups, config, LOG)
             if user_switch_status is not True:
                 raise RuntimeError(user_switch_status)
+        config['tsi.current_command'] = command
         function(msg, connector, config, LOG)
     except:
         msg = str(sys.exc_info()[1])
@@ -365,25 +538,20 @@ def process(connector: Connector, config: dict, LOG: Logger, one_shot=False):
     my_umask = os.umask(0o22)
     os.umask(my_umask)
     bss = config.get('tsi.bss', BSS.BSS())
-    functions = init_functions(bss)
+    functions = init_functions(bss, config)
 
     while True:
         bss.cleanup(config)
         try:
-            message = Utils.encode(connector.read_message())
+            message = Message(Utils.encode(connector.read_message()))
         except IOError:
             LOG.info("Peer shutdown, stopping worker.")
+            Shell.close_all(config)
+            config.pop('tsi.ls_cache', None)
             connector.close()
             return
         os.chdir(config['tsi.safe_dir'])
-        command = None
-        function = None
-        for cmd in functions:
-            have_cmd = re.search(r".*#%s\n" % cmd, message, re.M)
-            if have_cmd:
-                command = cmd
-                function = functions.get(cmd)
-                break
+        command, function = get_function(message, functions)
         if function is None:
             connector.failed("Unknown #TSI_* command")
         elif "TSI_PING" == command:
@@ -427,8 +595,10 @@ def main(argv=None):
     if msg==None:
         LOG.reinit("UNICORE-TSI-worker", verbose, use_syslog)
         LOG.info("Worker %s started." % str(number))
-        connector = Connector(socket1, socket2, LOG)
-        process(connector, config, LOG)
+        while socket1 is not None:
+            connector = Connector(socket1, socket2, LOG, config)
+            process(connector, config, LOG)
+            (socket1, socket2) = Server.next_session(config, LOG)
     else:
         LOG.reinit("UNICORE-TSI-port-forwarding", verbose, use_syslog)
         LOG.info("Port forwarder worker %s started." % str(number))
@@ -0,0 +1,172 @@
+"""
+Incremental reading of growing files, such as the output of running
+jobs (TSI_TAIL)
+
+UNICORE/X sends the offsets up to which it has already read the files,
+and gets back only the data appended since then, for all files in a
+single reply. Optionally, the TSI waits until new data is available
+(long-poll). While waiting, the directories of the files are watched
+using inotify (if available), and the files are checked periodically
+in any case, since inotify does not see changes made by other hosts
+on network file systems.
+"""
+
+import ctypes
+import io
+import os
+import os.path
+import select
+import stat
+import time
+import IO
+from Connector import Connector
+from Log import Logger
+from Utils import expand_variables, extract_number
+
+# inotify events (see inotify(7))
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+
+
+class Watcher(object):
+    """ Waits for changes to the files in the given directories,
+    using inotify where available, and a plain sleep otherwise
+    """
+
+    def __init__(self, directories):
+        self.fd = -1
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            return
+        if fd < 0:
+            return
+        mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        for directory in directories:
+            libc.inotify_add_watch(fd, os.fsencode(directory), mask)
+        self.fd = fd
+
+    def wait(self, timeout: float):
+        """ Waits until something changed, or at most 'timeout' seconds """
+        if self.fd < 0:
+            time.sleep(timeout)
+            return
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if len(readable) > 0:
+            try:
+                os.read(self.fd, 65536)
+            except OSError:
+                pass
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def get_size(path: str) -> int:
+    """ Returns the size of the (regular) file, or -1 if it does not exist """
+    try:
+        file_info = os.stat(path)
+    except OSError:
+        return -1
+    if not stat.S_ISREG(file_info.st_mode):
+        return -1
+    return file_info.st_size
+
+
+def has_new_data(files: list) -> bool:
+    """ Returns True if any of the (path, offset) files has changed """
+    for path, offset in files:
+        size = get_size(path)
+        if size >= 0 and size != offset:
+            return True
+    return False
+
+
+def wait_for_data(files: list, timeout: float, poll_interval: float):
+    """ Waits until any of the files has new data, or at most 'timeout' seconds """
+    deadline = time.time() + timeout
+    watcher = Watcher(set(os.path.dirname(path) for path, _ in files))
+    try:
+        while not has_new_data(files):
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            watcher.wait(min(remaining, poll_interval))
+    finally:
+        watcher.close()
+
+
+def tail(msg: str, connector: Connector, config: dict, LOG: Logger):
+    """ Returns the data appended to one or more files since the given offsets.
+       The message sent by UNICORE/X contains one line
+           #TSI_TAIL_FILE <offset> <file name>
+       per file, and optionally:
+           TSI_WAIT   - if there is no new data, wait up to the given
+                        number of seconds (limited by 'tsi.tail.max_wait')
+           TSI_LENGTH - maximum number of bytes to return per file
+                        (limited by 'tsi.tail.max_length')
+       Reply:
+           TSI_OK
+           TSI_TAIL <index of the file in the request> <offset> <length>
+           ...
+           ENDOFMESSAGE
+       followed by the data of the files (in the order of the request)
+       on the data channel. The offset is where the returned data starts
+       in the file: it is 0 if the file has become shorter than the
+       offset given by UNICORE/X (i.e. it was truncated or replaced),
+       and -1 if the file does not exist.
+    """
+    files = []
+    for line in msg.splitlines():
+        if line.startswith("#TSI_TAIL_FILE "):
+            try:
+                offset, path = line[len("#TSI_TAIL_FILE "):].split(" ", 1)
+                files.append((expand_variables(path), int(offset)))
+            except ValueError:
+                connector.failed("Invalid file specification '%s'" % line)
+                return
+    if len(files) == 0:
+        connector.failed("No files given")
+        return
+    max_length = int(config.get('tsi.tail.max_length', 1048576))
+    length = extract_number(msg, "LENGTH")
+    if length < 0 or length > max_length:
+        length = max_length
+    wait = min(extract_number(msg, "WAIT"), int(config.get('tsi.tail.max_wait', 60)))
+    if wait > 0 and not has_new_data(files):
+        wait_for_data(files, wait, float(config.get('tsi.tail.poll_interval', 1)))
+
+    opened = []
+    parts = []
+    try:
+        header = ""
+        for index, (path, offset) in enumerate(files):
+            try:
+                # non-blocking, in case the file is a FIFO
+                f = io.FileIO(os.open(path, os.O_RDONLY | os.O_NONBLOCK), "rb")
+            except OSError:
+                header += "TSI_TAIL %d -1 0\n" % index
+                continue
+            opened.append(f)
+            file_info = os.fstat(f.fileno())
+            if not stat.S_ISREG(file_info.st_mode):
+                header += "TSI_TAIL %d -1 0\n" % index
+                continue
+            if file_info.st_size < offset or offset < 0:
+                offset = 0
+            available = min(file_info.st_size - offset, length)
+            parts.append((f, path, offset, available))
+            header += "TSI_TAIL %d %d %d\n" % (index, offset, available)
+        connector.ok(header + "ENDOFMESSAGE")
+        transfer = connector.new_transfer()
+        for f, path, offset, available in parts:
+            IO.send_file_data(connector, f, offset, available, transfer, path, LOG)
+        LOG.debug("Sent %s" % transfer)
+    finally:
+        for f in opened:
+            f.close()
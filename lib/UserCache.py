@@ -21,6 +21,9 @@ class UserCache(object):
         self.groups = {}
         self.users_timestamps = {}
         self.groups_timestamps = {}
+        # uid/gid -> (name, timestamp), name is None if unknown
+        self.user_names = {}
+        self.group_names = {}
         self.use_id_to_resolve_groups = use_id_to_resolve_groups
             
     def prepare_users(self, user):
@@ -82,6 +85,30 @@ class UserCache(object):
         self.prepare_users(user)
         return self.homes.get(user)
 
+    # returns the user name for a uid (None if unknown)
+    def get_name_4uid(self, uid):
+        entry = self.user_names.get(uid)
+        if entry is None or self.expired(entry[1]):
+            try:
+                name = pwd.getpwuid(uid).pw_name
+            except KeyError:
+                name = None
+            entry = (name, time.time())
+            self.user_names[uid] = entry
+        return entry[0]
+
+    # returns the group name for a gid (None if unknown)
+    def get_name_4gid(self, gid):
+        entry = self.group_names.get(gid)
+        if entry is None or self.expired(entry[1]):
+            try:
+                name = grp.getgrgid(gid).gr_name
+            except KeyError:
+                name = None
+            entry = (name, time.time())
+            self.group_names[gid] = entry
+        return entry[0]
+
     # Establish the list of all (including supplementary) groups the user
     # is member of.
     # Arguments: user name and primary group id.
@@ -123,6 +150,7 @@ class UserCache(object):
             return
         self.groups[group] = g.gr_gid
         self.groups_timestamps[group] = time.time()
+        self.group_names[g.gr_gid] = (group, self.groups_timestamps[group])
 
     # Fills up all per user caches with freshly obtained information
     # Argument: user name
@@ -142,4 +170,5 @@ class UserCache(object):
         self.gids[user] = gid
         self.homes[user] = home
         self.all_groups[user] = self.get_gids_4user_nc(user, gid, old_group_info)
-        self.users_timestamps[user] = time.time()
\ No newline at end of file
+        self.users_timestamps[user] = time.time()
+        self.user_names[uid] = (user, self.users_timestamps[user])
\ No newline at end of file
@@ -9,6 +9,8 @@ import string
 import subprocess
 
 from random import choice
+from Message import Message, parse
+import Shell
 
 def encode(message):
     if type(message) is not type(u" "):
@@ -20,13 +22,9 @@ def extract_parameter(message: str, parameter: str, default_value:str = None) ->
     """
     Extracts a value that is given in the form '#TSI_<parameter> <value>\n'
     from the message. Returns the value or None if it is not present or empty.
+    If the message is not yet a parsed Message, it is parsed first.
     """
-    result = re.search(r".*^#TSI_%s (.*)\n.*" % parameter, message, re.M)
-    if result is None or result.group(1)=='':
-        value = default_value
-    else:
-        value = result.group(1)
-    return value
+    return parse(message).get(parameter, default_value)
 
 
 def extract_number(message: str, parameter: str) -> int:
@@ -35,21 +33,20 @@ def extract_number(message: str, parameter: str) -> int:
     from the message. Returns the value as an integer, or -1 if 
     it is not given or not an integer.
     """
-    result = extract_parameter(message, parameter)
-    try:
-        value = int(float(result))
-    except:
-        value = -1
-    return value
+    return parse(message).get_number(parameter)
 
 
 def expand_variables(message: str) -> str:
     """
-    Expands $HOME and $USER into the values from the current environment
+    Expands $HOME and $USER into the values from the current environment.
+    A parsed Message is returned as a (re-parsed) Message.
     """
-    message = message.replace("$HOME", os.environ.get('HOME', ""))
-    message = message.replace("$LOGNAME", os.environ.get('LOGNAME', ""))
-    return message.replace("$USER", os.environ.get('USER', ""))
+    expanded = message.replace("$HOME", os.environ.get('HOME', ""))
+    expanded = expanded.replace("$LOGNAME", os.environ.get('LOGNAME', ""))
+    expanded = expanded.replace("$USER", os.environ.get('USER', ""))
+    if isinstance(message, Message):
+        expanded = Message(expanded)
+    return expanded
 
 
 def addperms(path: str, mode: int):
@@ -61,25 +58,43 @@ def addperms(path: str, mode: int):
     os.chmod(path, mode)
 
 
-def run_command(cmd: str, discard=False, child_pids=None, login_shell=True):
+def run_command(cmd: str, discard=False, child_pids=None, login_shell=True, config: dict = None):
     """
     Runs command, capturing the output if the discard flag is True.
     Returns a success flag and the output.
     If the command returns a non-zero exit code, the success flag is
     set to False and the error message is returned.
     The output is returned as a string (UTF-8 encoded)
+    If the config is given, login shell commands are run using the
+    cached login environment of the current user, if enabled, or the
+    persistent shell of the current user, if enabled and the output is
+    captured (see Shell.py)
     """
     output = ""
+    env = None
+    if login_shell and config is not None:
+        env = Shell.get_login_environment(config)
+        if env is not None:
+            login_shell = False
+    if login_shell and not discard and config is not None \
+            and config.get('tsi.persistent_shell', False):
+        try:
+            exit_code, output = Shell.run_command(cmd, config)
+        except OSError as e:
+            return False, "Command '%s' failed: %s" % (cmd, str(e))
+        if exit_code != 0:
+            return False, "Command '%s' failed with code %s: %s" % (cmd, exit_code, output)
+        return True, output
     try:
         cmds = ["/bin/bash", "-l", "-c", cmd]
         if not login_shell:
             cmds.pop(1)
         if not discard:
-            raw_output = subprocess.check_output(cmds, bufsize=4096, stderr=subprocess.STDOUT)
+            raw_output = subprocess.check_output(cmds, bufsize=4096, stderr=subprocess.STDOUT, env=env)
             output = raw_output.decode("UTF-8")
         else:
             # run the command in the background
-            child = subprocess.Popen(cmds, start_new_session=True)
+            child = subprocess.Popen(cmds, start_new_session=True, env=env)
             # remember child to be able to clean up processes later
             if child_pids is not None:
                 child_pids.append(child.pid)
@@ -91,11 +106,11 @@ def run_command(cmd: str, discard=False, child_pids=None, login_shell=True):
     return success, output
 
 
-def run_and_report(cmd, connector, login_shell=True):
+def run_and_report(cmd, connector, login_shell=True, config: dict = None):
     """
     Runs the command and report success/failure with output
     """
-    (success, output) = run_command(cmd, login_shell=login_shell)
+    (success, output) = run_command(cmd, login_shell=login_shell, config=config)
     if not success:
         connector.failed(output)
     else:
@@ -0,0 +1,158 @@
+#
+# Pool of pre-forked TSI worker processes
+#
+#  - the workers are forked by the main TSI process (which has already
+#    done the expensive setup like BSS.init()), and wait for sessions
+#  - for each new session, the main process tells an idle worker (via
+#    a UNIX domain socket) to call back to UNICORE/X and open the
+#    (command, data) socket pair
+#  - when UNICORE/X closes the session, the worker tells the main process
+#    that it is idle again, or exits after a configurable number of
+#    sessions, in which case a fresh worker is started
+#
+
+import os
+import select
+import signal
+import socket
+import Server
+from Log import Logger
+
+
+class WorkerPool(object):
+
+    def __init__(self, config: dict, LOG: Logger):
+        self.config = config
+        self.LOG = LOG
+        self.size = int(config.get('tsi.worker_pool.size', 0))
+        self.max_sessions = int(config.get('tsi.worker_pool.max_sessions', 0))
+        # master side: worker pid -> [channel, idle flag]
+        self.workers = {}
+        # worker side
+        self.channel = None
+        self.sessions = 0
+
+    def maintain(self, server: socket.socket):
+        """ Check the state of the workers and fork new ones if required.
+
+        In the main process, this returns None. In a newly forked worker,
+        it returns the (command, data) sockets of the first session.
+        """
+        self.update()
+        while len(self.workers) < self.size:
+            session = self.spawn(server)
+            if session is not None:
+                return session
+        return None
+
+    def spawn(self, server: socket.socket):
+        """ Fork a new worker, which waits for a session to be handed to it """
+        worker_id = self.config.get('tsi.worker.id', 1)
+        master_end, worker_end = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        pid = os.fork()
+        if pid == 0:
+            # child
+            server.close()
+            master_end.close()
+            self.close()
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            self.channel = worker_end
+            self.config['tsi.worker_pool'] = self
+            return self.next_session()
+        else:
+            worker_end.close()
+            self.workers[pid] = [master_end, True]
+            self.config['tsi.worker.id'] = worker_id + 1
+            self.LOG.info("Started pooled tsi-worker-%d (pid %s)" % (worker_id, pid))
+            return None
+
+    def wait(self, server: socket.socket) -> bool:
+        """ Wait for a new connection on the server socket, or for
+        a status message from one of the workers.
+        Returns True if a new connection is waiting to be accepted.
+        """
+        channels = [c[0] for c in self.workers.values()]
+        readable, _, _ = select.select([server] + channels, [], [])
+        return server in readable
+
+    def update(self):
+        """ Read status messages sent by the workers (without blocking),
+        marking them idle or removing them if they have exited.
+        """
+        channels = {c[0]: pid for pid, c in self.workers.items()}
+        if len(channels) == 0:
+            return
+        readable, _, _ = select.select(list(channels), [], [], 0)
+        for channel in readable:
+            pid = channels[channel]
+            try:
+                status = channel.recv(64)
+            except OSError:
+                status = b""
+            if status.startswith(b"idle"):
+                self.workers[pid][1] = True
+            else:
+                channel.close()
+                del self.workers[pid]
+                self.LOG.info("Pooled worker (pid %s) exited" % pid)
+
+    def dispatch(self, address, local_port: int) -> bool:
+        """ Hand the new session to an idle worker, which will call back
+        to UNICORE/X at the given address.
+        Returns False if no idle worker was available
+        """
+        self.update()
+        request = ("session %s %s %s" % (address[0], address[1], local_port)).encode("UTF-8")
+        for pid, worker in self.workers.items():
+            channel, idle = worker
+            if not idle:
+                continue
+            try:
+                channel.sendall(request)
+            except OSError as e:
+                self.LOG.info("Cannot hand session to worker (pid %s): %s" % (pid, str(e)))
+                continue
+            worker[1] = False
+            self.LOG.info("Session handed to pooled worker (pid %s)" % pid)
+            return True
+        return False
+
+    def next_session(self):
+        """ Worker side: wait for the next session to be handed over,
+        and call back to UNICORE/X.
+        Returns the (command, data) sockets, or (None, None) if the worker
+        should exit, because the main TSI has gone, or the maximum number
+        of sessions has been reached.
+        """
+        while True:
+            if self.sessions > 0:
+                if 0 < self.max_sessions <= self.sessions:
+                    self.LOG.info("Worker handled %d sessions, exiting." % self.sessions)
+                    self.channel.close()
+                    return None, None
+                try:
+                    self.channel.sendall(b"idle")
+                except OSError:
+                    return None, None
+            try:
+                request = self.channel.recv(1024).decode("UTF-8").split(" ")
+            except OSError:
+                request = []
+            if len(request) != 4 or request[0] != "session":
+                self.channel.close()
+                return None, None
+            self.sessions += 1
+            _, host, port, local_port = request
+            try:
+                sockets = Server.callback((host, port), 2, int(local_port), self.config, self.LOG)
+                return sockets[0], sockets[1]
+            except OSError as e:
+                self.LOG.info("Error creating connections to UNICORE/X : %s" % str(e))
+
+    def close(self):
+        """ Close the master side of the worker channels
+        (used in child processes that are not part of the pool)
+        """
+        for channel, _ in self.workers.values():
+            channel.close()
+        self.workers = {}
@@ -0,0 +1,41 @@
+"""
+Micro-benchmark for finding the command in a message from UNICORE/X.
+Parsing the message is a single pass, and looking up the command
+afterwards does not depend on the message size at all. For comparison,
+the previous approach (one regular expression per registered command)
+is measured as well.
+"""
+
+import re
+import timeit
+import BSS, Message, TSI
+
+def make_message(script_lines: int) -> str:
+    msg = "#TSI_SUBMIT\n#TSI_USPACE_DIR /tmp\n#TSI_QUEUE batch\n"
+    msg += "echo 'some line of a large user script'\n" * script_lines
+    return msg
+
+def regex_dispatch(message: str, functions: dict):
+    for cmd in functions:
+        if re.search(r".*#%s\n" % cmd, message, re.M):
+            return cmd, functions[cmd]
+    return None, None
+
+def usec(func, number):
+    return 1e6 * timeit.timeit(func, number=number) / number
+
+def main():
+    functions = TSI.init_functions(BSS.BSS())
+    print("%8s %9s %12s %12s %12s" % ("lines", "bytes", "parse", "dispatch", "regex (old)"))
+    for script_lines in [10, 100, 1000, 10000, 100000]:
+        message = make_message(script_lines)
+        parsed = Message.Message(message)
+        number = max(1, 100000 // (script_lines + 1))
+        t_parse = usec(lambda: Message.Message(message), number)
+        t_dispatch = usec(lambda: TSI.get_function(parsed, functions), 10000)
+        t_regex = usec(lambda: regex_dispatch(message, functions), number)
+        print("%8d %9d %10.1fus %10.2fus %10.1fus" % (script_lines, len(message),
+                                                      t_parse, t_dispatch, t_regex))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+import unittest
+import io
+import os
+import shutil
+import tarfile
+import Archive, Log, MockConnector, TSI
+
+
+class TestArchive(unittest.TestCase):
+    def setUp(self):
+        self.LOG = Log.Logger("tsi.testing", use_syslog=False)
+        self.config = TSI.get_default_config()
+        self.base = os.getcwd() + "/build/archive_test"
+        shutil.rmtree(self.base, ignore_errors=True)
+        self.files = {"out/a.txt": b"a" * 100000, "out/b.log": b"log",
+                      "out/sub/c.txt": b"c", "out/sub/deeper/d.dat": os.urandom(1000),
+                      "out/tmp/e.txt": b"e"}
+        for name, content in self.files.items():
+            path = self.base + "/" + name
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(content)
+        os.symlink("a.txt", self.base + "/out/link")
+
+    def tearDown(self):
+        shutil.rmtree(self.base, ignore_errors=True)
+
+    def get_archive(self, extra=""):
+        msg = "#TSI_GET_ARCHIVE\n#TSI_FILE %s/out\n%s" % (self.base, extra)
+        connector = MockConnector.MockConnector(None, None, None, None, self.LOG)
+        connector.buf_size = 4096
+        Archive.get_archive(msg, connector, self.config, self.LOG)
+        reply = connector.control_out.getvalue().splitlines()
+        # decode the chunked stream
+        stream = io.BytesIO(connector.data_out.getvalue())
+        data = b""
+        while True:
+            length = int(stream.readline())
+            if length == 0:
+                break
+            data += stream.read(length)
+        self.assertEqual(b"", stream.read())
+        self.assertEqual(["TSI_OK", "ENDOFMESSAGE"], reply[:2])
+        self.assertTrue(reply[-1].startswith("END_ARCHIVE"))
+        self.assertEqual(len(data), int(reply[-1].split(" ")[2]))
+        return data
+
+    def contents(self, data):
+        with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+            result = {}
+            for member in tar.getmembers():
+                if member.isfile():
+                    result[member.name] = tar.extractfile(member).read()
+                elif member.issym():
+                    result[member.name] = "-> " + member.linkname
+                else:
+                    result[member.name] = None
+            return result
+
+    def test_archive(self):
+        expected = dict(self.files)
+        expected.update({"out": None, "out/sub": None, "out/sub/deeper": None,
+                         "out/tmp": None, "out/link": "-> a.txt"})
+        self.assertEqual(expected, self.contents(self.get_archive()))
+        data = self.get_archive("#TSI_ARCHIVE_FORMAT tar.gz\n")
+        self.assertEqual(b"\x1f\x8b", data[:2])
+        self.assertEqual(expected, self.contents(data))
+
+    def test_filters(self):
+        data = self.get_archive("#TSI_INCLUDE *.txt\n#TSI_INCLUDE sub/deeper/*\n"
+                                "#TSI_EXCLUDE tmp\n")
+        self.assertEqual(["out/a.txt", "out/sub/c.txt", "out/sub/deeper/d.dat"],
+                         list(self.contents(data)))
+
+    def test_errors(self):
+        connector = MockConnector.MockConnector(None, None, None, None, self.LOG)
+        msg = "#TSI_GET_ARCHIVE\n#TSI_FILE %s/out/a.txt\n" % self.base
+        Archive.get_archive(msg, connector, self.config, self.LOG)
+        self.assertTrue(connector.control_out.getvalue().startswith("TSI_FAILED"))
+        os.chmod(self.base + "/out/b.log", 0)
+        if not os.access(self.base + "/out/b.log", os.R_OK):
+            connector = MockConnector.MockConnector(None, None, None, None, self.LOG)
+            msg = "#TSI_GET_ARCHIVE\n#TSI_FILE %s/out\n" % self.base
+            Archive.get_archive(msg, connector, self.config, self.LOG)
+            reply = connector.control_out.getvalue().splitlines()
+            self.assertEqual("ERROR EACCES %s/out/b.log" % self.base, reply[-2])
+            self.assertTrue(reply[-1].endswith(" 1"))
+
+    def test_read_error(self):
+        class FailingFile(object):
+            def __init__(self):
+                self.calls = 0
+            def read(self, size):
+                self.calls += 1
+                if self.calls > 1:
+                    raise OSError(5, "Input/output error")
+                return b"x" * size
+        out = io.BytesIO()
+        with tarfile.open(fileobj=out, mode="w|") as tar:
+            archiver = Archive.Archiver(tar, [], [], None, self.LOG)
+            info = tarfile.TarInfo("failing")
+            info.size = 100000
+            reader = Archive.PaddedReader(FailingFile(), info.size)
+            tar.addfile(info, reader)
+            self.assertEqual(5, reader.read_error.errno)
+            archiver.add(self.base + "/out/b.log", "b.log", os.lstat(self.base + "/out/b.log"))
+        # the member keeps its size, so the following members are intact
+        contents = self.contents(out.getvalue())
+        self.assertEqual(100000, len(contents["failing"]))
+        self.assertEqual(b"log", contents["b.log"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+import unittest
+import os
+import shutil
+import Copy, Log, MockConnector, TSI
+
+
+class TestCopy(unittest.TestCase):
+    def setUp(self):
+        self.LOG = Log.Logger("tsi.testing", use_syslog=False)
+        self.config = TSI.get_default_config()
+        self.base = os.getcwd() + "/build/copy_test"
+        shutil.rmtree(self.base, ignore_errors=True)
+        os.makedirs(self.base + "/src/sub/subsub")
+        for name, content in [("a.txt", "a"), ("sub/b.txt", "b" * 100000),
+                              ("sub/subsub/c.txt", "")]:
+            with open(self.base + "/src/" + name, "w") as f:
+                f.write(content)
+        os.chmod(self.base + "/src/a.txt", 0o750)
+        os.symlink("a.txt", self.base + "/src/link")
+
+    def tearDown(self):
+        shutil.rmtree(self.base, ignore_errors=True)
+
+    def run_command(self, function, source, target):
+        msg = "#TSI_SOURCE %s\n#TSI_TARGET %s\n" % (source, target)
+        connector = MockConnector.MockConnector(None, None, None, None, self.LOG)
+        function(msg, connector, self.config, self.LOG)
+        return connector.control_out.getvalue().splitlines()
+
+    def assert_same_tree(self, expected, actual):
+        for dirpath, dirnames, filenames in os.walk(expected):
+            other = actual + dirpath[len(expected):]
+            self.assertEqual(sorted(dirnames + filenames), sorted(os.listdir(other)))
+            for name in filenames:
+                path = dirpath + "/" + name
+                if os.path.islink(path):
+                    self.assertEqual(os.readlink(path), os.readlink(other + "/" + name))
+                    continue
+                with open(path, "rb") as f1, open(other + "/" + name, "rb") as f2:
+                    self.assertEqual(f1.read(), f2.read())
+                self.assertEqual(os.stat(path).st_mode, os.stat(other + "/" + name).st_mode)
+
+    def test_copy(self):
+        src = self.base + "/src"
+        # copy into existing directory
+        os.mkdir(self.base + "/target")
+        reply = self.run_command(Copy.copy, src, self.base + "/target")
+        self.assertEqual(["TSI_OK", "END_COPY 4 100001 0"], reply)
+        self.assert_same_tree(src, self.base + "/target/src")
+        # single file
+        reply = self.run_command(Copy.copy, src + "/sub/b.txt", self.base + "/b_copy.txt")
+        self.assertEqual("END_COPY 1 100000 0", reply[-1])
+        # existing targets are overwritten
+        reply = self.run_command(Copy.copy, src, self.base + "/target")
+        self.assertEqual(["TSI_OK", "END_COPY 4 100001 0"], reply)
+        self.assert_same_tree(src, self.base + "/target/src")
+        reply = self.run_command(Copy.copy, src + "/link", self.base + "/b_copy.txt")
+        self.assertEqual("END_COPY 1 0 0", reply[-1])
+        self.assertEqual("a.txt", os.readlink(self.base + "/b_copy.txt"))
+        # per-file errors
+        os.chmod(src + "/a.txt", 0o000)
+        if not os.access(src + "/a.txt", os.R_OK):
+            reply = self.run_command(Copy.copy, src, self.base + "/copy2")
+            self.assertEqual(["TSI_OK", "ERROR EACCES %s/a.txt" % src, "END_COPY 3 100000 1"], reply)
+        os.chmod(src + "/a.txt", 0o750)
+        # failures
+        reply = self.run_command(Copy.copy, self.base + "/nonexistent", self.base + "/x")
+        self.assertTrue(reply[0].startswith("TSI_FAILED"))
+        os.symlink(src, self.base + "/src_link")
+        for target in [src + "/sub", src + "/../src/sub/new", self.base + "/src_link/new"]:
+            reply = self.run_command(Copy.copy, src, target)
+            self.assertTrue(reply[0].startswith("TSI_FAILED"))
+            reply = self.run_command(Copy.move, src, target)
+            self.assertTrue(reply[0].startswith("TSI_FAILED"))
+        reply = self.run_command(Copy.copy, src + "/a.txt", src)
+        self.assertTrue(reply[0].startswith("TSI_FAILED"))
+
+    def test_copy_read_only(self):
+        src = self.base + "/src"
+        for d in [src + "/sub/subsub", src + "/sub", src]:
+            os.chmod(d, 0o555)
+        try:
+            reply = self.run_command(Copy.copy, src, self.base + "/copy")
+            self.assertEqual(["TSI_OK", "END_COPY 4 100001 0"], reply)
+            self.assert_same_tree(src, self.base + "/copy")
+            self.assertEqual(0o555, os.stat(self.base + "/copy/sub").st_mode & 0o777)
+        finally:
+            for d in [src, src + "/sub", src + "/sub/subsub",
+                      self.base + "/copy", self.base + "/copy/sub", self.base + "/copy/sub/subsub"]:
+                if os.path.isdir(d):
+                    os.chmod(d, 0o755)
+
+    def test_move(self):
+        src = self.base + "/src"
+        shutil.copytree(src, self.base + "/expected", symlinks=True)
+        reply = self.run_command(Copy.move, src, self.base + "/moved")
+        self.assertEqual(["TSI_OK", "END_COPY 1 0 0"], reply)
+        self.assertFalse(os.path.exists(src))
+        self.assert_same_tree(self.base + "/expected", self.base + "/moved")
+        # moving across file systems copies and removes the source
+        other_fs = "/dev/shm"
+        if os.path.isdir(other_fs) and os.stat(other_fs).st_dev != os.stat(self.base).st_dev:
+            target = other_fs + "/tsi_move_test"
+            shutil.rmtree(target, ignore_errors=True)
+            reply = self.run_command(Copy.move, self.base + "/moved", target)
+            self.assertEqual(["TSI_OK", "END_COPY 4 100001 0"], reply)
+            self.assertFalse(os.path.exists(self.base + "/moved"))
+            self.assert_same_tree(self.base + "/expected", target)
+            shutil.rmtree(target)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,14 @@
 import unittest
+import hashlib
 import io
 import os
+import resource
+import shutil
+import socket
+import threading
+import zlib
 import MockConnector
-import Log, TSI
+import Connector, IO, Log, TSI
 
 
 class TestIO(unittest.TestCase):
@@ -44,6 +50,103 @@ ENDOFMESSAGE
         data_out.close()
         os.chdir(cwd)
         
+    def test_get_file_chunk_sendfile(self):
+        cwd = os.getcwd()
+        path = cwd + "/build/testfile_sendfile.bin"
+        content = os.urandom(1024*1024)
+        with open(path, "wb") as f:
+            f.write(content)
+        msg = """#TSI_GETFILECHUNK
+#TSI_FILE %s
+#TSI_START 1000
+#TSI_LENGTH %d
+ENDOFMESSAGE
+""" % (path, len(content))
+        command, command_peer = socket.socketpair()
+        data, data_peer = socket.socketpair()
+        connector = Connector.Connector(command, data, self.LOG)
+        self.assertTrue(connector.zero_copy)
+        expected = content[1000:]
+        received = []
+        def receive():
+            with data_peer.makefile("rb") as f:
+                received.append(f.read(len(expected)))
+        reader = threading.Thread(target=receive)
+        reader.start()
+        command_peer.sendall(msg.encode("UTF-8"))
+        TSI.process(connector, self.config, self.LOG)
+        reader.join()
+        with command_peer.makefile("r") as f:
+            self.assertEqual("TSI_OK\n", f.readline())
+            self.assertEqual("TSI_LENGTH %d\n" % len(expected), f.readline())
+        self.assertEqual(expected, received[0])
+        connector.close()
+        for s in command_peer, data_peer:
+            s.close()
+        os.chdir(cwd)
+
+    def test_get_file_chunks(self):
+        cwd = os.getcwd()
+        paths = [cwd + "/build/testfile_chunks_%d.bin" % i for i in range(2)]
+        contents = [os.urandom(100000), os.urandom(5000)]
+        for path, content in zip(paths, contents):
+            with open(path, "wb") as f:
+                f.write(content)
+        msg = """#TSI_GETFILECHUNKS
+#TSI_CHUNK 2000 3000 %s
+#TSI_CHUNK 0 1000 %s
+#TSI_CHUNK 4000 2000 %s
+#TSI_CHUNK 0 1000 %s
+ENDOFMESSAGE
+""" % (paths[1], paths[1], paths[1], paths[0])
+        command, command_peer = socket.socketpair()
+        data, data_peer = socket.socketpair()
+        connector = Connector.Connector(command, data, self.LOG)
+        # sorted by file and start byte, the last chunk is truncated
+        expected = [(3, contents[0][0:1000]), (1, contents[1][0:1000]),
+                    (0, contents[1][2000:5000]), (2, contents[1][4000:5000])]
+        received = []
+        def receive():
+            with data_peer.makefile("rb") as f:
+                received.append(f.read(sum(len(e[1]) for e in expected)))
+        reader = threading.Thread(target=receive)
+        reader.start()
+        command_peer.sendall(msg.encode("UTF-8"))
+        TSI.process(connector, self.config, self.LOG)
+        reader.join()
+        with command_peer.makefile("r") as f:
+            self.assertEqual("TSI_OK\n", f.readline())
+            for index, content in expected:
+                self.assertEqual("TSI_CHUNK %d %d\n" % (index, len(content)), f.readline())
+            self.assertEqual("ENDOFMESSAGE\n", f.readline())
+        self.assertEqual(b"".join(e[1] for e in expected), received[0])
+        connector.close()
+        for s in command_peer, data_peer:
+            s.close()
+        for path in paths:
+            os.unlink(path)
+        os.chdir(cwd)
+
+    def test_get_file_chunks_many_files(self):
+        base = os.getcwd() + "/build/chunks_test"
+        os.makedirs(base, exist_ok=True)
+        self.addCleanup(shutil.rmtree, base, True)
+        msg = "#TSI_GETFILECHUNKS\n"
+        for i in range(200):
+            with open("%s/%d" % (base, i), "wb") as f:
+                f.write(b"%03d" % i)
+            msg += "#TSI_CHUNK 0 3 %s/%d\n" % (base, i)
+        # files are opened one at a time
+        limits = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (len(os.listdir("/proc/self/fd")) + 20, limits[1]))
+        try:
+            connector = MockConnector.MockConnector(None, None, None, None, self.LOG)
+            IO.get_file_chunks(msg, connector, self.config, self.LOG)
+        finally:
+            resource.setrlimit(resource.RLIMIT_NOFILE, limits)
+        self.assertEqual(b"".join(b"%03d" % i for i in sorted(range(200), key=lambda i: str(i))),
+                         connector.data_out.getvalue())
+
     def test_put_file_chunk(self):
         cwd = os.getcwd()
         path = cwd + "/build/testfile.txt"
@@ -94,5 +197,260 @@ ENDOFMESSAGE
         self.assertTrue(data.decode() in lines[0])
         os.chdir(cwd)
 
+    def test_put_file_chunk_buffered(self):
+        cwd = os.getcwd()
+        self.config['tsi.io.preallocate'] = True
+        self.config['tsi.io.fsync'] = "end"
+        path = cwd + "/build/testfile_put.bin"
+        data = os.urandom(100*1024)
+        msg = """#TSI_PUTFILECHUNK
+#TSI_FILE %s 600
+#TSI_FILESACTION 1
+#TSI_START 0
+#TSI_LENGTH %d
+ENDOFMESSAGE
+""" % (path, len(data))
+        for sent in data, data[:5000]:
+            control_source = io.BufferedReader(io.BytesIO(msg.encode("UTF-8")))
+            control_in = io.TextIOWrapper(control_source)
+            control_out = io.StringIO()
+            data_in = io.BytesIO(sent)
+            connector = MockConnector.MockConnector(control_in, control_out,
+                                                    data_in, None, self.LOG)
+            connector.buf_size = 1000
+            TSI.process(connector, self.config, self.LOG)
+            result = control_out.getvalue()
+            control_source.close()
+            # incomplete data: failure reported, preallocated space released
+            self.assertEqual(sent is data, "TSI_FAILED" not in result)
+            with open(path, "rb") as f:
+                self.assertEqual(sent, f.read())
+            os.chdir(cwd)
+
+    def test_compression(self):
+        path = os.getcwd() + "/build/testfile_compressed.txt"
+        text = b"".join(b"line %d of a compressible file\n" % i for i in range(100000))
+        random = os.urandom(200000)
+        self.config['tsi.io.buffer_size'] = 65536
+        for content, compressed in (text, True), (random, False):
+            with open(path, "wb") as f:
+                f.write(content)
+            msg = "#TSI_GETFILECHUNK\n#TSI_FILE %s\n#TSI_START 10\n#TSI_LENGTH %d\n" \
+                  "#TSI_COMPRESSION zlib\n" % (path, len(content))
+            connector = MockConnector.MockConnector(None, None, None, None, self.LOG)
+            IO.get_file_chunk(msg, connector, self.config, self.LOG)
+            reply = connector.control_out.getvalue()
+            self.assertTrue(("TSI_LENGTH %d\n" % (len(content) - 10)) in reply)
+            self.assertEqual(compressed, "TSI_COMPRESSION zlib" in reply)
+            sent = connector.data_out.getvalue()
+            if compressed:
+                self.assertTrue(len(sent) < len(content) / 5)
+                sent = zlib.decompress(sent)
+            self.assertEqual(content[10:], sent)
+        # compressed upload
+        msg = "#TSI_PUTFILECHUNK\n#TSI_FILE %s 600\n#TSI_FILESACTION 1\n#TSI_LENGTH %d\n" \
+              "#TSI_COMPRESSION zlib\n" % (path, len(text))
+        connector = MockConnector.MockConnector(None, None, io.BytesIO(zlib.compress(text)),
+                                                None, self.LOG)
+        connector.buf_size = 1000
+        IO.put_file_chunk(msg, connector, self.config, self.LOG)
+        self.assertTrue("TSI_COMPRESSION zlib" in connector.control_out.getvalue())
+        with open(path, "rb") as f:
+            self.assertEqual(text, f.read())
+        # over a socket, which is not closed after sending the data
+        command, command_peer = socket.socketpair()
+        data, data_peer = socket.socketpair()
+        connector = Connector.Connector(command, data, self.LOG)
+        errors = []
+        def put():
+            try:
+                IO.put_file_chunk(msg, connector, self.config, self.LOG)
+            except Exception as e:
+                errors.append(e)
+        writer = threading.Thread(target=put)
+        writer.start()
+        data_peer.sendall(zlib.compress(text))
+        writer.join(10)
+        self.assertFalse(writer.is_alive())
+        self.assertEqual([], errors)
+        with open(path, "rb") as f:
+            self.assertEqual(text, f.read())
+        connector.close()
+        for s in command_peer, data_peer:
+            s.close()
+        # data after the compressed stream
+        connector = MockConnector.MockConnector(None, None, io.BytesIO(zlib.compress(text) + b"x"),
+                                                None, self.LOG)
+        with self.assertRaises(IOError):
+            IO.put_file_chunk(msg, connector, self.config, self.LOG)
+        # truncated stream
+        connector = MockConnector.MockConnector(None, None, io.BytesIO(zlib.compress(text)[:5000]),
+                                                None, self.LOG)
+        with self.assertRaises(IOError):
+            IO.put_file_chunk(msg, connector, self.config, self.LOG)
+        # not requested by UNICORE/X or disabled
+        self.assertIsNone(IO.get_compression("#TSI_GETFILECHUNK\n", self.config))
+        self.config['tsi.io.compression'] = False
+        self.assertIsNone(IO.get_compression(msg, self.config))
+        os.unlink(path)
+
+    def test_put_file_chunk_at_offset(self):
+        path = os.getcwd() + "/build/testfile_parallel.bin"
+        if os.path.exists(path):
+            os.unlink(path)
+        data = os.urandom(400000)
+        part = len(data) // 4
+        def put(index):
+            msg = "#TSI_PUTFILECHUNK\n#TSI_FILE %s 600\n#TSI_FILESACTION 4\n" \
+                  "#TSI_OFFSET %d\n#TSI_LENGTH %d\n#TSI_FILE_SIZE %d\n" % (
+                      path, index * part, part, len(data))
+            config = TSI.get_default_config()
+            config['tsi.io.preallocate'] = True
+            connector = MockConnector.MockConnector(
+                None, None, io.BytesIO(data[index * part:(index + 1) * part]), None, self.LOG)
+            connector.buf_size = 1000
+            IO.put_file_chunk(msg, connector, config, self.LOG)
+        # write the parts concurrently, in reverse order
+        writers = [threading.Thread(target=put, args=(i,)) for i in reversed(range(4))]
+        for w in writers:
+            w.start()
+        for w in writers:
+            w.join()
+        with open(path, "rb") as f:
+            self.assertEqual(data, f.read())
+        # never truncates
+        put(1)
+        self.assertEqual(len(data), os.stat(path).st_size)
+        msg = "#TSI_PUTFILECHUNK\n#TSI_FILE %s 600\n#TSI_FILESACTION 4\n#TSI_LENGTH 10\n" % path
+        connector = MockConnector.MockConnector(None, None, io.BytesIO(), None, self.LOG)
+        IO.put_file_chunk(msg, connector, self.config, self.LOG)
+        self.assertTrue("TSI_FAILED" in connector.control_out.getvalue())
+        os.unlink(path)
+
+    def test_sparse(self):
+        path = os.getcwd() + "/build/testfile_sparse.bin"
+        mb = 1024 * 1024
+        blocks = [(0, os.urandom(mb)), (10 * mb, os.urandom(mb))]
+        with open(path, "wb") as f:
+            for offset, block in blocks:
+                f.seek(offset)
+                f.write(block)
+            f.truncate(20 * mb)
+        self.addCleanup(os.unlink, path)
+        with open(path, "rb") as f:
+            content = f.read()
+        # invalid extents
+        msg = "#TSI_PUTFILECHUNK\n#TSI_FILE %s 600\n#TSI_LENGTH 100\n" \
+              "#TSI_SPARSE true\n#TSI_EXTENT 50 60\n" % (path + ".invalid")
+        connector = MockConnector.MockConnector(None, None, io.BytesIO(), None, self.LOG)
+        IO.put_file_chunk(msg, connector, self.config, self.LOG)
+        self.assertTrue("TSI_FAILED" in connector.control_out.getvalue())
+        msg = "#TSI_GETFILECHUNK\n#TSI_FILE %s\n#TSI_START 0\n#TSI_LENGTH %d\n" \
+              "#TSI_SPARSE true\n" % (path, len(content))
+        connector = MockConnector.MockConnector(None, None, None, None, self.LOG)
+        IO.get_file_chunk(msg, connector, self.config, self.LOG)
+        reply = connector.control_out.getvalue().splitlines()
+        sent = connector.data_out.getvalue()
+        if "TSI_SPARSE 2" not in reply:
+            # sent as plain data
+            self.assertEqual(content, sent)
+            self.skipTest("File system does not support holes")
+        self.assertEqual(["TSI_EXTENT 0 %d" % mb, "TSI_EXTENT %d %d" % (10 * mb, mb)],
+                         [l for l in reply if l.startswith("TSI_EXTENT")])
+        self.assertEqual(blocks[0][1] + blocks[1][1], sent)
+        # write it back as sparse file
+        os.unlink(path)
+        msg = "#TSI_PUTFILECHUNK\n#TSI_FILE %s 600\n#TSI_FILESACTION 1\n#TSI_LENGTH %d\n" \
+              "#TSI_SPARSE true\n#TSI_EXTENT 0 %d\n#TSI_EXTENT %d %d\n" % (
+                  path, len(content), mb, 10 * mb, mb)
+        self.config['tsi.io.preallocate'] = True
+        connector = MockConnector.MockConnector(None, None, io.BytesIO(sent), None, self.LOG)
+        IO.put_file_chunk(msg, connector, self.config, self.LOG)
+        with open(path, "rb") as f:
+            self.assertEqual(content, f.read())
+        self.assertTrue(os.stat(path).st_blocks * 512 < 4 * mb)
+
+    def test_reply_buffer(self):
+        command, command_peer = socket.socketpair()
+        data, data_peer = socket.socketpair()
+        connector = Connector.Connector(command, data, self.LOG)
+        command_peer.setblocking(False)
+        with connector.reply():
+            connector.ok("START")
+            connector.write_message("line")
+            with self.assertRaises(BlockingIOError):
+                command_peer.recv(1024)
+        self.assertEqual(b"TSI_OK\nSTART\nline\n", command_peer.recv(1024))
+        # written when the buffer is full
+        connector.reply_buffer_size = 10
+        with connector.reply():
+            connector.write_message("0123456789")
+            self.assertEqual(b"0123456789\n", command_peer.recv(1024))
+        connector.close()
+        for s in command_peer, data_peer:
+            s.close()
+
+    def test_transfer_block_size(self):
+        # buffers are not enlarged unless adaptive
+        transfer = Connector.Transfer(1000, 16777216)
+        self.assertEqual(1000, transfer.max_block_size)
+        for _ in range(20):
+            transfer.record(transfer.block_size)
+        self.assertEqual(1000, transfer.block_size)
+        self.assertEqual(20000, transfer.total)
+        transfer = Connector.Transfer(1000, 1500, adaptive=True)
+        for _ in range(Connector.Transfer.window):
+            transfer.record(transfer.block_size)
+        self.assertEqual(1500, transfer.block_size)
+        self.assertFalse(transfer.adaptive)
+
+    def checksum(self, msg):
+        cwd = os.getcwd()
+        control_source = io.BufferedReader(io.BytesIO((msg + "ENDOFMESSAGE\n").encode("UTF-8")))
+        control_in = io.TextIOWrapper(control_source)
+        control_out = io.StringIO()
+        connector = MockConnector.MockConnector(control_in, control_out, None, None, self.LOG)
+        TSI.process(connector, self.config, self.LOG)
+        os.chdir(cwd)
+        return control_out.getvalue().splitlines()
+
+    def test_checksum(self):
+        path = os.getcwd() + "/build/checksum_test"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = os.urandom(3000000)
+        with open(path, "wb") as f:
+            f.write(data)
+        self.addCleanup(os.unlink, path)
+        self.config['tsi.io.buffer_size'] = 65536
+        msg = "#TSI_CHECKSUM\n#TSI_FILE %s\n#TSI_ALGORITHMS MD5,SHA-256\n" % path
+        self.assertEqual(["TSI_OK", "MD5 " + hashlib.md5(data).hexdigest(),
+                          "SHA-256 " + hashlib.sha256(data).hexdigest(),
+                          "ENDOFMESSAGE"], self.checksum(msg))
+        msg = "#TSI_CHECKSUM\n#TSI_FILE %s\n#TSI_START 10\n#TSI_LENGTH 100000\n" % path
+        self.assertEqual("MD5 " + hashlib.md5(data[10:100010]).hexdigest(), self.checksum(msg)[1])
+        for algorithm in ["foo", "shake_128"]:
+            msg = "#TSI_CHECKSUM\n#TSI_FILE %s\n#TSI_ALGORITHMS %s\n" % (path, algorithm)
+            lines = self.checksum(msg)
+            self.assertTrue(lines[0].startswith("TSI_FAILED"))
+            self.assertEqual("ENDOFMESSAGE", lines[-1])
+        # cached in the extended attributes
+        self.config['tsi.checksum.xattr_cache'] = True
+        msg = "#TSI_CHECKSUM\n#TSI_FILE %s\n#TSI_ALGORITHMS SHA1\n" % path
+        self.assertEqual("SHA1 " + hashlib.sha1(data).hexdigest(), self.checksum(msg)[1])
+        try:
+            value = os.getxattr(path, "user.unicore.checksum.sha1").decode("UTF-8")
+        except OSError:
+            self.skipTest("Extended attributes not supported")
+        self.assertTrue(value.endswith(hashlib.sha1(data).hexdigest()))
+        info = os.stat(path)
+        value = "%d %d %s" % (info.st_size, info.st_mtime_ns, "cached")
+        os.setxattr(path, "user.unicore.checksum.sha1", value.encode("UTF-8"))
+        self.assertEqual("SHA1 cached", self.checksum(msg)[1])
+        # modifying the file invalidates the cached value
+        with open(path, "ab") as f:
+            f.write(b"more")
+        self.assertEqual("SHA1 " + hashlib.sha1(data + b"more").hexdigest(),
+                         self.checksum(msg)[1])
+
 if __name__ == '__main__':
     unittest.main()
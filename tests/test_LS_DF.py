@@ -1,7 +1,12 @@
 import unittest
 import io
 import os
-import IO, Log
+import sys
+import re
+import shutil
+import stat
+import time
+import IO, Log, UserCache
 import MockConnector
 
 
@@ -22,6 +27,89 @@ class TestLS(unittest.TestCase):
         out = conn.control_out.getvalue()
         print(out)
 
+    def test_list_recursive(self):
+        base = os.getcwd() + "/build/ls_test"
+        shutil.rmtree(base, ignore_errors=True)
+        os.makedirs(base + "/sub/subsub")
+        for f in ["a.txt", "sub/b.txt", "sub/subsub/c.txt"]:
+            with open(base + "/" + f, "w") as fh:
+                fh.write("test")
+        os.symlink(base + "/nonexistent", base + "/broken_link")
+        conn = MockConnector.MockConnector(None, None, None, None, self.LOG)
+        IO.list_directory(conn, base, True)
+        lines = conn.control_out.getvalue().splitlines()
+        names = [re.match(r" .{5} \d+ \d+ (.*)", l).group(1) for l in lines if l.startswith(" ")]
+        self.assertEqual(sorted(names), sorted([base + "/a.txt", base + "/sub",
+                                                base + "/sub/b.txt", base + "/sub/subsub",
+                                                base + "/sub/subsub/c.txt"]))
+        # directory entries are listed after their content and a "<"
+        sub = names.index(base + "/sub")
+        self.assertTrue(names.index(base + "/sub/b.txt") < sub)
+        self.assertEqual(2, lines.count("<"))
+        shutil.rmtree(base)
+
+    def test_list_parallel(self):
+        base = os.getcwd() + "/build/ls_parallel"
+        shutil.rmtree(base, ignore_errors=True)
+        for i in range(4):
+            os.makedirs(base + "/d%d/e%d/f%d" % (i, i, i))
+            for f in ["x", "d%d/y" % i, "d%d/e%d/f%d/z" % (i, i, i)]:
+                with open(base + "/" + f, "w") as fh:
+                    fh.write("test")
+        # deeper than the (lowered) recursion limit
+        os.makedirs(base + "/deep" + 150 * "/d")
+        outputs = []
+        limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(100)
+        try:
+            for threads in [0, 4]:
+                conn = MockConnector.MockConnector(None, None, None, None, self.LOG)
+                IO.list_directory(conn, base, True, threads=threads)
+                outputs.append(conn.control_out.getvalue())
+        finally:
+            sys.setrecursionlimit(limit)
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertEqual(12 + 151, outputs[0].splitlines().count("<"))
+        shutil.rmtree(base)
+
+    def test_access(self):
+        for path in ["/tmp", "tests/test_LS_DF.py", "tests/input"]:
+            st = os.stat(path)
+            access = IO.get_access(st, IO.get_identity())
+            self.assertEqual((os.access(path, os.R_OK), os.access(path, os.W_OK),
+                              os.access(path, os.X_OK)), access)
+        st = os.stat_result((stat.S_IFREG | 0o750, 0, 0, 1, 1000, 100, 0, 0, 0, 0))
+        self.assertEqual((True, True, True), IO.get_access(st, (1000, {100})))
+        self.assertEqual((True, False, True), IO.get_access(st, (1001, {100, 200})))
+        self.assertEqual((False, False, False), IO.get_access(st, (1001, {200})))
+        self.assertEqual((True, True, True), IO.get_access(st, (0, {0})))
+
+    def test_stat_many(self):
+        paths = ["/tmp", "tests/test_LS_DF.py", "/x_y_z", "tests/input"]
+        msg = "#TSI_STAT_MANY\n" + "".join("#TSI_STAT_FILE %s\n" % p for p in paths)
+        conn = MockConnector.MockConnector(None, None, None, None, self.LOG)
+        IO.stat_many(msg, conn, {}, self.LOG)
+        lines = conn.control_out.getvalue().splitlines()
+        self.assertEqual(["TSI_OK", "START_LISTING"], lines[:2])
+        self.assertEqual("END_LISTING", lines[-1])
+        expected = []
+        for path in paths:
+            if os.path.exists(path):
+                expected += IO.get_info(path).splitlines()
+            else:
+                expected.append("!ENOENT " + path)
+        self.assertEqual(expected, lines[2:-1])
+
+    def test_unknown_owner(self):
+        path = "/tmp"
+        st = os.stat(path)
+        st = os.stat_result((st.st_mode, 0, 0, 1, 987654, 987655, 0, 0, 0, 0))
+        info = IO.get_info(path, statinfo=st)
+        self.assertTrue(info.endswith(" 987654 987655"))
+        uc = UserCache.UserCache(60, self.LOG)
+        info = IO.get_info(path, statinfo=st, user_cache=uc)
+        self.assertTrue(info.endswith(" 987654 987655"))
+
     def test_ls(self):
         path = os.getcwd()
         msg = """#TSI_LS
@@ -39,6 +127,44 @@ ENDOFMESSAGE
         self.assertTrue("START_LISTING" in out)
         self.assertTrue("END_LISTING" in out)
 
+    def ls_page(self, path, offset, limit, config):
+        msg = """#TSI_LS
+#TSI_FILE %s
+#TSI_LS_MODE N
+#TSI_LS_OFFSET %d
+#TSI_LS_LIMIT %d
+ENDOFMESSAGE
+""" % (path, offset, limit)
+        conn = MockConnector.MockConnector(None, None, None, None, self.LOG)
+        IO.ls(msg, conn, config, self.LOG)
+        lines = conn.control_out.getvalue().splitlines()
+        self.assertEqual("END_LISTING", lines[-2])
+        names = [os.path.basename(l.split(" ")[-1]) for l in lines if l.startswith(" ")]
+        return names, int(lines[-1].split(" ")[1])
+
+    def test_ls_paged(self):
+        base = os.getcwd() + "/build/ls_paged"
+        shutil.rmtree(base, ignore_errors=True)
+        os.makedirs(base)
+        expected = ["file_%02d" % i for i in range(25)]
+        for name in reversed(expected):
+            with open(base + "/" + name, "w"):
+                pass
+        config = {}
+        listed = []
+        for offset in range(0, 30, 10):
+            names, total = self.ls_page(base, offset, 10, config)
+            self.assertEqual(25, total)
+            listed += names
+        self.assertEqual(expected, listed)
+        self.assertEqual(1, len(config['tsi.ls_cache']))
+        # modifying the directory invalidates the cached list
+        os.unlink(base + "/file_00")
+        names, total = self.ls_page(base, 0, 2, config)
+        self.assertEqual(24, total)
+        self.assertEqual(["file_01", "file_02"], names)
+        shutil.rmtree(base)
+
     def test_df(self):
         path = os.getcwd()
         msg = """#TSI_DF
@@ -54,6 +180,43 @@ ENDOFMESSAGE
         self.assertFalse("TSI_FAILED" in out)
         print(out)
 
+    def df(self, path, config):
+        msg = "#TSI_DF\n#TSI_FILE %s\nENDOFMESSAGE\n" % path
+        conn = MockConnector.MockConnector(None, None, None, None, self.LOG)
+        IO.df(msg, conn, config, self.LOG)
+        lines = conn.control_out.getvalue().splitlines()
+        return dict(l.split(" ") for l in lines if l.split(" ")[0] in ["TOTAL", "FREE", "USER"])
+
+    def test_df_cache(self):
+        path = os.getcwd()
+        mount_point = IO.get_mount_point(path)
+        self.assertTrue(os.path.ismount(mount_point))
+        st = os.statvfs(path)
+        config = {'tsi.df.quota_cmd': "echo 12345 %s",
+                  'tsi.use_login_shell': False}
+        result = self.df(path, config)
+        self.assertEqual(str(st.f_blocks * st.f_frsize), result["TOTAL"])
+        self.assertEqual("12345", result["USER"])
+        self.assertTrue(mount_point in config['tsi.df_cache'])
+        # cached values are re-used
+        config['tsi.df_cache'][mount_point] = (time.time(), 100, 50)
+        config['tsi.df.quota_cmd'] = "echo 0"
+        result = self.df(path, config)
+        self.assertEqual({"TOTAL": "100", "FREE": "50", "USER": "12345"}, result)
+        # excluded paths
+        config['tsi.df.exclude'] = [os.path.dirname(path) + "/"]
+        result = self.df(path, config)
+        self.assertEqual({"TOTAL": "-1", "FREE": "-1", "USER": "-1"}, result)
+
+    def test_quota_cmd(self):
+        config = {'tsi.use_login_shell': False, 'tsi.df.cache_ttl': 0}
+        # mount point is quoted
+        config['tsi.df.quota_cmd'] = "test -e %s || echo 7"
+        self.assertEqual("7", IO.get_user_quota("/x_y_z; echo 99", config, self.LOG))
+        # no or other placeholders
+        config['tsi.df.quota_cmd'] = "echo 3 %d"
+        self.assertEqual("3", IO.get_user_quota("/", config, self.LOG))
+
     def test_df_nosuchpath(self):
         path = "/x_y_z"
         msg = """#TSI_DF
@@ -0,0 +1,35 @@
+import unittest
+import Message, Utils
+
+
+class TestMessage(unittest.TestCase):
+
+    def test_parameters(self):
+        msg = Message.Message("#TSI_SUBMIT\n#TSI_QUEUE fast\n#TSI_FILE /tmp/x 600\n"
+                              "echo '#TSI_QUEUE slow'\n#TSI_QUEUE slow\n"
+                              "#TSI_EMPTY \n#TSI_NODES 4\n#TSI_LAST no_newline")
+        self.assertEqual("fast", msg.get("QUEUE"))
+        self.assertEqual("/tmp/x 600", msg.get("FILE"))
+        self.assertEqual(4, msg.get_number("NODES"))
+        self.assertEqual(-1, msg.get_number("QUEUE"))
+        self.assertEqual(-1, msg.get_number("NOPE"))
+        self.assertEqual("dflt", msg.get("EMPTY", "dflt"))
+        self.assertIsNone(msg.get("SUBMIT"))
+        self.assertIsNone(msg.get("LAST"))
+        self.assertTrue(msg.has("NODES"))
+        self.assertFalse(msg.has("EMPTY"))
+        # still usable as a plain string
+        self.assertTrue(msg.startswith("#TSI_SUBMIT\n"))
+        self.assertTrue("echo" in msg)
+
+    def test_compatibility_wrappers(self):
+        msg = Message.Message("#TSI_USPACE_DIR $HOME/job\n#TSI_TIME 3600.0\n")
+        self.assertEqual(3600, Utils.extract_number(msg, "TIME"))
+        self.assertIs(msg, Message.parse(msg))
+        expanded = Utils.expand_variables(msg)
+        self.assertTrue(isinstance(expanded, Message.Message))
+        self.assertFalse("$HOME" in expanded.get("USPACE_DIR"))
+
+
+if __name__ == '__main__':
+    unittest.main()
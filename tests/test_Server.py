@@ -3,6 +3,7 @@ import os
 import signal
 import socket
 import sys
+import threading
 import time
 import Connector, Log, Server, TSI
 
@@ -28,6 +29,57 @@ class TestServer(unittest.TestCase):
         port = Server.get_unicorex_port(self.config, params)
         self.assertEqual("5678", port)
   
+    def test_Reserve_Local_Ports(self):
+        print("*** test_Reserve_Local_Ports")
+        self.assertEqual(50000, Server.reserve_local_ports(self.config, 2))
+        self.assertEqual(50002, Server.reserve_local_ports(self.config, 2))
+        self.config['tsi.local_portrange'] = (50010, 50000, 50010)
+        self.assertEqual(50010, Server.reserve_local_ports(self.config, 2))
+        self.assertEqual((50001, 50000, 50010), self.config['tsi.local_portrange'])
+        self.config['tsi.local_portrange'] = (0, -1, -1)
+        self.assertEqual(0, Server.reserve_local_ports(self.config, 2))
+
+    def test_Socket_Buffers(self):
+        print("*** test_Socket_Buffers")
+        self.config['tsi.socket.send_buffer'] = 1048576
+        self.config['tsi.socket.receive_buffer'] = 1048576
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        default_size = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        Server.set_buffer_sizes(sock, self.config)
+        size = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        self.assertTrue(size > default_size)
+        sock.close()
+        # buffers are set before connecting
+        server = socket.create_server(('localhost', 0))
+        server.listen(1)
+        self.config['tsi.local_portrange'] = (0, -1, -1)
+        sock = Server.open_connection(server.getsockname()[:2], 5, self.config)
+        self.assertEqual(size, sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF))
+        sock.close()
+        server.close()
+
+    def test_Connect_With_Retry(self):
+        print("*** test_Connect_With_Retry")
+        self.config['tsi.local_portrange'] = (0, -1, -1)
+        address = ('localhost', 24436)
+        start = time.time()
+        with self.assertRaises(ConnectionRefusedError):
+            Server.connect_with_retry(address, 1, self.config)
+        self.assertTrue(time.time() - start < 2)
+        # start listening a bit later
+        def listen():
+            time.sleep(0.5)
+            server = Server.create_server(address[0], address[1], self.config)
+            server.listen(2)
+            (conn, _) = server.accept()
+            conn.close()
+            server.close()
+        t = threading.Thread(target=listen)
+        t.start()
+        sock = Server.connect_with_retry(address, 5, self.config)
+        sock.close()
+        t.join()
+
     def test_Connect(self):
         print("*** test_Connect")
         # fork a fake U/X
@@ -40,6 +92,7 @@ class TestServer(unittest.TestCase):
             time.sleep(5)
             command.close()
             data.close()
+            os._exit(0)
         else:
             # this is the fake U/X
             # wait a bit to allow for setup of server socket at TSI
@@ -93,6 +146,7 @@ class TestServer(unittest.TestCase):
             except IOError:
                 print("Got: " + str(sys.exc_info()[1]))
                 connector.close()
+            os._exit(0)
         else:
             # parent, this is the fake U/X
             # wait a bit to allow for setup of server socket at TSI
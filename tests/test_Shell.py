@@ -0,0 +1,74 @@
+import unittest
+import os
+import time
+import Shell, TSI, Utils
+
+
+class TestShell(unittest.TestCase):
+    def setUp(self):
+        self.config = TSI.get_default_config()
+        self.config['tsi.persistent_shell'] = True
+
+    def tearDown(self):
+        Shell.close_all(self.config)
+
+    def test_run(self):
+        cwd = os.getcwd()
+        os.chdir("/tmp")
+        (success, output) = Utils.run_command("echo \"Hello\"; pwd", config=self.config)
+        self.assertTrue(success)
+        self.assertEqual("Hello\n/tmp\n", output)
+        shell = list(self.config['tsi.shells'].values())[0]
+        # no trailing newline, non-ASCII characters
+        (success, output) = Utils.run_command("printf 'Grüße'", config=self.config)
+        self.assertTrue(success)
+        self.assertEqual("Grüße", output)
+        # state does not leak between commands
+        Utils.run_command("export FOO=bar; cd /", config=self.config)
+        (success, output) = Utils.run_command("echo \"x${FOO}x\"; pwd", config=self.config)
+        self.assertEqual("xx\n/tmp\n", output)
+        (success, output) = Utils.run_command("echo error >&2; exit 3", config=self.config)
+        self.assertFalse(success)
+        self.assertTrue("code 3" in output)
+        self.assertTrue("error" in output)
+        # still the same shell
+        self.assertEqual(1, len(self.config['tsi.shells']))
+        self.assertTrue(shell is list(self.config['tsi.shells'].values())[0])
+        os.chdir(cwd)
+
+    def test_idle_timeout(self):
+        self.config['tsi.persistent_shell.idle_timeout'] = 1
+        (success, _) = Utils.run_command("true", config=self.config)
+        self.assertTrue(success)
+        shell = list(self.config['tsi.shells'].values())[0]
+        time.sleep(1.5)
+        Shell.cleanup(self.config)
+        self.assertEqual(0, len(self.config['tsi.shells']))
+        self.assertIsNotNone(shell.process.poll())
+        (success, output) = Utils.run_command("echo again", config=self.config)
+        self.assertTrue(success)
+        self.assertEqual("again\n", output)
+
+    def test_login_environment(self):
+        self.config['tsi.persistent_shell'] = False
+        self.config['tsi.login_env.cache_ttl'] = 60
+        self.config['tsi.current_command'] = "TSI_DF"
+        cmd = "shopt -q login_shell && echo login; echo $PATH"
+        (success, output) = Utils.run_command(cmd, config=self.config)
+        self.assertTrue(success)
+        self.assertEqual(1, len(self.config['tsi.login_envs']))
+        env = list(self.config['tsi.login_envs'].values())[0][1]
+        self.assertTrue(env["PATH"] in output.splitlines())
+        self.assertFalse("login\n" in output)
+        # re-uses the cached environment
+        Utils.run_command(cmd, config=self.config)
+        self.assertTrue(env is list(self.config['tsi.login_envs'].values())[0][1])
+        # commands configured to use a real login shell
+        self.config['tsi.current_command'] = "TSI_EXECUTESCRIPT"
+        (success, output) = Utils.run_command(cmd, config=self.config)
+        self.assertTrue(success)
+        self.assertTrue("login\n" in output)
+
+
+if __name__ == '__main__':
+    unittest.main()
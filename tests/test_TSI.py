@@ -1,6 +1,6 @@
 import unittest
 import io, os
-import BecomeUser, Log, TSI, UserCache, Utils
+import BecomeUser, BSS, Log, Message, TSI, UserCache, Utils
 import MockConnector
 
 
@@ -78,7 +78,7 @@ ENDOFMESSAGE
         self.config['tsi.get_userkeys_cmd'] = "echo test123_userkey"
         self.config['tsi.get_userinfo_cmd'] = "echo 'name=testuser\nlocation=somewhere\nfoo=bar'"
         msg = """#TSI_GET_USER_INFO
-        #TSI_IDENTITY %s NONE
+#TSI_IDENTITY %s NONE
 ENDOFMESSAGE
 """ % os.environ["USER"]
         control_source = io.BufferedReader(io.BytesIO(msg.encode("UTF-8")))
@@ -154,5 +154,114 @@ ENDOFMESSAGE
         control_source.close()
         os.chdir(cwd)
 
+    def test_dispatch(self):
+        functions = TSI.init_functions(BSS.BSS())
+        msg = Message.Message("#TSI_EXECUTESCRIPT\n#TSI_FOO bar\n#TSI_LS\n")
+        command, function = TSI.get_function(msg, functions)
+        self.assertEqual("TSI_EXECUTESCRIPT", command)
+        self.assertEqual(TSI.execute_script, function)
+        msg = Message.Message("#TSI_PING_UIDX\n#TSI_PING\n")
+        command, _ = TSI.get_function(msg, functions)
+        self.assertEqual("TSI_PING", command)
+        msg = Message.Message("#TSI_NO_SUCH_COMMAND\n")
+        self.assertEqual((None, None), TSI.get_function(msg, functions))
+
+    def test_plugin_function(self):
+        cwd = os.getcwd()
+        def hello(msg, connector, config, LOG):
+            connector.ok("Hello %s" % Utils.extract_parameter(msg, "NAME"))
+        TSI.register_function("TSI_HELLO", hello, self.config)
+        msg = """#TSI_HELLO
+#TSI_NAME plugin
+ENDOFMESSAGE
+"""
+        control_source = io.BufferedReader(io.BytesIO(msg.encode("UTF-8")))
+        control_in = io.TextIOWrapper(control_source)
+        control_out = io.StringIO()
+        connector = MockConnector.MockConnector(control_in, control_out, None,
+                                                None, self.LOG)
+        TSI.process(connector, self.config, self.LOG)
+        result = control_out.getvalue()
+        self.assertTrue("TSI_OK" in result)
+        self.assertTrue("Hello plugin" in result)
+        control_source.close()
+        os.chdir(cwd)
+
+    def test_get_identity(self):
+        self.assertEqual(("nobody", ["users", "staff"]),
+                         TSI.get_identity("#TSI_PING\n#TSI_IDENTITY nobody users:staff\n"))
+        self.assertIsNone(TSI.get_identity("#TSI_PING\n#TSI_IDENTITY nobody\n"))
+        # only the header of a batch is used
+        msg = "#TSI_BATCH\n#TSI_BATCH_ITEM\n#TSI_PING\n#TSI_IDENTITY root root\n"
+        self.assertIsNone(TSI.get_identity(msg))
+
+    def test_batch(self):
+        cwd = os.getcwd()
+        msg = """#TSI_BATCH
+#TSI_IDENTITY nobody NONE
+#TSI_BATCH_ITEM
+#TSI_EXECUTESCRIPT
+echo "Hello"
+echo "World"
+#TSI_BATCH_ITEM
+#TSI_PING
+#TSI_BATCH_ITEM
+#TSI_GETFILECHUNK
+#TSI_FILE /etc/passwd
+#TSI_BATCH_ITEM
+#TSI_NO_SUCH_COMMAND
+#TSI_BATCH_ITEM
+#TSI_EXECUTESCRIPT
+echo "#TSI_IDENTITY root root"
+#TSI_BATCH_ITEM
+#TSI_EXECUTESCRIPT
+#TSI_IDENTITY root root
+echo "Hello"
+#TSI_BATCH_ITEM
+#TSI_LS
+#TSI_FILE %s
+#TSI_LS_MODE N
+#TSI_BATCH_ITEM
+#TSI_DF
+#TSI_FILE %s
+ENDOFMESSAGE
+""" % (cwd + "/tests", cwd)
+        control_source = io.BufferedReader(io.BytesIO(msg.encode("UTF-8")))
+        control_in = io.TextIOWrapper(control_source)
+        control_out = io.StringIO()
+        connector = MockConnector.MockConnector(control_in, control_out, None,
+                                                None, self.LOG)
+        TSI.process(connector, self.config, self.LOG)
+        result = control_out.getvalue()
+        print(result)
+        lines = result.splitlines()
+        self.assertEqual("TSI_OK", lines[0])
+        self.assertEqual("ENDOFMESSAGE", lines[-1])
+        # split into the replies to the items
+        replies = []
+        pos = 1
+        while pos < len(lines) - 1:
+            header = lines[pos].split(" ")
+            self.assertEqual(["TSI_BATCH_REPLY", str(len(replies))], header[:2])
+            count = int(header[2])
+            replies.append(lines[pos + 1:pos + 1 + count])
+            pos += 1 + count
+        self.assertEqual(8, len(replies))
+        self.assertEqual(["TSI_OK", "Hello", "World", ""], replies[0][:1] + replies[0][-3:])
+        self.assertEqual(["TSI_OK", TSI.MY_VERSION], replies[1])
+        for index in 2, 3, 5:
+            self.assertEqual(1, len(replies[index]))
+            self.assertTrue(replies[index][0].startswith("TSI_FAILED"))
+        # only '#TSI_IDENTITY' lines are rejected, not the script content
+        self.assertEqual("TSI_OK", replies[4][0])
+        self.assertTrue("#TSI_IDENTITY root root" in replies[4])
+        # commands writing buffered replies
+        self.assertEqual("TSI_OK", replies[6][0])
+        self.assertTrue(any(l.endswith("/tests/test_TSI.py") for l in replies[6]))
+        self.assertEqual("TSI_OK", replies[7][0])
+        self.assertTrue(any(l.startswith("TOTAL ") for l in replies[7]))
+        control_source.close()
+        os.chdir(cwd)
+
 if __name__ == '__main__':
     unittest.main()
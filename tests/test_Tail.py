@@ -0,0 +1,80 @@
+import unittest
+import os
+import shutil
+import threading
+import time
+import Log, MockConnector, TSI, Tail
+
+
+class TestTail(unittest.TestCase):
+    def setUp(self):
+        self.LOG = Log.Logger("tsi.testing", use_syslog=False)
+        self.config = TSI.get_default_config()
+        self.base = os.getcwd() + "/build/tail_test"
+        shutil.rmtree(self.base, ignore_errors=True)
+        os.makedirs(self.base)
+
+    def tearDown(self):
+        shutil.rmtree(self.base, ignore_errors=True)
+
+    def tail(self, files, extra=""):
+        msg = "#TSI_TAIL\n" + extra
+        for offset, path in files:
+            msg += "#TSI_TAIL_FILE %d %s\n" % (offset, path)
+        connector = MockConnector.MockConnector(None, None, None, None, self.LOG)
+        Tail.tail(msg, connector, self.config, self.LOG)
+        lines = connector.control_out.getvalue().splitlines()
+        self.assertEqual("TSI_OK", lines[0])
+        self.assertEqual("ENDOFMESSAGE", lines[-1])
+        result = [tuple(int(x) for x in l.split(" ")[1:]) for l in lines[1:-1]]
+        return result, connector.data_out.getvalue()
+
+    def test_tail(self):
+        stdout = self.base + "/stdout"
+        stderr = self.base + "/stderr"
+        with open(stdout, "w") as f:
+            f.write("Hello\n")
+        result, data = self.tail([(0, stdout), (0, stderr)])
+        self.assertEqual([(0, 0, 6), (1, -1, 0)], result)
+        self.assertEqual(b"Hello\n", data)
+        with open(stdout, "a") as f:
+            f.write("World\n")
+        with open(stderr, "w") as f:
+            f.write("error\n")
+        result, data = self.tail([(6, stdout), (0, stderr)], "#TSI_LENGTH 3\n")
+        self.assertEqual([(0, 6, 3), (1, 0, 3)], result)
+        self.assertEqual(b"Worerr", data)
+        # truncated file is read from the start
+        with open(stdout, "w") as f:
+            f.write("new\n")
+        result, data = self.tail([(12, stdout)])
+        self.assertEqual([(0, 0, 4)], result)
+        self.assertEqual(b"new\n", data)
+
+    def test_wait(self):
+        stdout = self.base + "/stdout"
+        with open(stdout, "w") as f:
+            f.write("Hello\n")
+        # no new data
+        start = time.time()
+        result, data = self.tail([(6, stdout)], "#TSI_WAIT 1\n")
+        self.assertTrue(time.time() - start >= 1)
+        self.assertEqual([(0, 6, 0)], result)
+        # data appended while waiting
+        def append():
+            time.sleep(0.5)
+            with open(stdout, "a") as f:
+                f.write("World\n")
+        writer = threading.Thread(target=append)
+        writer.start()
+        self.config['tsi.tail.poll_interval'] = 10
+        start = time.time()
+        result, data = self.tail([(6, stdout)], "#TSI_WAIT 20\n")
+        writer.join()
+        self.assertTrue(time.time() - start < 5)
+        self.assertEqual([(0, 6, 6)], result)
+        self.assertEqual(b"World\n", data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -43,6 +43,20 @@ class TestUserCache(unittest.TestCase):
         print("Home for non-existing 'foobarspam' user: %s" %
               uc.get_home_4user('foobarspam'))
 
+    def test_name_cache(self):
+        uc = UserCache.UserCache(2, self.LOG)
+        self.assertEqual("root", uc.get_name_4uid(0))
+        self.assertEqual(pwd.getpwuid(0).pw_name, uc.get_name_4uid(0))
+        # shared with the user info
+        user = self.getlogin()
+        uid = uc.get_uid_4user(user)
+        self.assertEqual(user, uc.user_names[uid][0])
+        # unknown IDs are cached, too
+        self.assertIsNone(uc.get_name_4uid(987654))
+        self.assertIsNone(uc.get_name_4gid(987654))
+        self.assertTrue(987654 in uc.user_names)
+        self.assertTrue(987654 in uc.group_names)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,75 @@
+import unittest
+import os
+import signal
+import socket
+import time
+import Log, Server, TSI
+
+class TestWorkerPool(unittest.TestCase):
+    def setUp(self):
+        self.LOG = Log.Logger("tsi.testing", use_syslog=False)
+        self.config = TSI.get_default_config()
+        self.config['tsi.my_addr'] = 'localhost'
+        self.config['tsi.my_port'] = 14435
+        self.config['tsi.unicorex_machine'] = 'localhost'
+        self.config['tsi.local_portrange'] = (0, -1, -1)
+        self.config['tsi.worker_pool.size'] = 1
+        self.config['tsi.worker_pool.max_sessions'] = 2
+
+    def run_tsi(self):
+        """ this is the TSI: main process and pooled workers """
+        try:
+            command, data, _ = Server.connect(self.config, self.LOG)
+            while command is not None:
+                command.sendall(b"%d\n" % os.getpid())
+                # wait until U/X closes the session
+                command.recv(1024)
+                command.close()
+                data.close()
+                command, data = Server.next_session(self.config, self.LOG)
+        finally:
+            os._exit(0)
+
+    def new_session(self, server):
+        host = self.config['tsi.my_addr']
+        port = self.config['tsi.my_port']
+        tsi = socket.create_connection((host, port))
+        tsi.sendall(b'newtsiprocess 24435')
+        (command, _) = server.accept()
+        (data, _) = server.accept()
+        worker_pid = int(command.recv(1024).decode().strip())
+        self.LOG.info("CLIENT: session handled by worker %s" % worker_pid)
+        command.close()
+        data.close()
+        tsi.close()
+        return worker_pid
+
+    def test_Pool(self):
+        print("*** test_Pool")
+        pid = os.fork()
+        if pid == 0:
+            self.run_tsi()
+        # this is the fake U/X
+        server = Server.create_server('localhost', 24435, self.config)
+        server.listen(2)
+        time.sleep(2)
+        try:
+            pids = []
+            for _ in range(0, 3):
+                pids.append(self.new_session(server))
+                time.sleep(0.5)
+            # first worker is re-used once, then replaced
+            self.assertEqual(pids[0], pids[1])
+            self.assertNotEqual(pids[1], pids[2])
+            self.assertNotEqual(pid, pids[0])
+        finally:
+            tsi = socket.create_connection(('localhost', self.config['tsi.my_port']))
+            tsi.sendall(b'shutdown')
+            tsi.close()
+            server.close()
+            time.sleep(1)
+            os.kill(pid, signal.SIGKILL)
+
+
+if __name__ == '__main__':
+    unittest.main()